@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Потоковая выгрузка таблиц бота в NDJSON или CSV для аналитики.
+
+Строки читаются курсором SQLite порциями по BATCH_SIZE и сразу отдаются
+генератором, поэтому память не зависит от размера таблицы. Соединение
+открывается только на чтение: в WAL читатель работает со своим снимком
+и не мешает писателю бота, вебхук продолжает писать во время выгрузки.
+
+Для инкрементальной выгрузки у каждой таблицы есть колонка-водяной знак
+(EXPORT_TABLES): с since отдаются только строки новее, по возрастанию
+знака, а последний отданный знак - since для следующего раза.
+
+    python export_db.py bot.db                          # все таблицы в ./<таблица>.ndjson
+    python export_db.py bot.db users cooking_sessions --format csv --gzip --out export
+    python export_db.py bot.db cooking_sessions --since 2026-10-01T00:00:00
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import zlib
+
+# таблица -> колонка водяного знака (None - выгружается только целиком).
+# У daily_active знака нет: day один на все строки дня, и строки, дописанные
+# в тот же день после выгрузки, с since = day потерялись бы
+EXPORT_TABLES = {
+    "users": "updated_at",
+    "cooking_sessions": "updated_at",
+    "pantry": "added_at",
+    "daily_active": None,
+    "broadcasts": "updated_at",
+    "inbox": "received_at",
+    "stats_counters": None,
+}
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+BATCH_SIZE = 1000
+
+
+def connect_readonly(db_path):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+
+def export_stream(db_path, table, fmt="ndjson", since=None, compress=False, stats=None):
+    """Генератор байтов выгрузки таблицы. В stats пишутся rows и watermark -
+    последний отданный водяной знак, since для следующей выгрузки"""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"unknown table: {table}")
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format: {fmt}")
+    watermark = EXPORT_TABLES[table]
+    if since is not None and watermark is None:
+        raise ValueError(f"{table} has no watermark column")
+    stats = stats if stats is not None else {}
+    stats.update(rows=0, watermark=since)
+
+    query = f"SELECT * FROM {table}"
+    params = ()
+    if since is not None:
+        query += f" WHERE {watermark} > ?"
+        params = (since,)
+    if watermark:
+        query += f" ORDER BY {watermark}"
+
+    compressor = zlib.compressobj(wbits=31) if compress else None  # 31 - формат gzip
+
+    def emit(text):
+        data = text.encode("utf-8")
+        return compressor.compress(data) if compressor else data
+
+    conn = connect_readonly(db_path)
+    try:
+        cur = conn.execute(query, params)
+        columns = [column[0] for column in cur.description]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == "csv":
+            writer.writerow(columns)
+        while True:
+            rows = cur.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                if fmt == "csv":
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+            stats["rows"] += len(rows)
+            if watermark:
+                stats["watermark"] = rows[-1][columns.index(watermark)]
+            chunk = emit(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+            if chunk:
+                yield chunk
+        tail = emit(buffer.getvalue())
+        if compressor:
+            tail += compressor.flush()
+        if tail:
+            yield tail
+    finally:
+        conn.close()
+
+
+def export_filename(table, fmt, compress):
+    return f"{table}.{fmt}" + (".gz" if compress else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка таблиц бота в NDJSON/CSV")
+    parser.add_argument("db", help="путь к bot.db")
+    parser.add_argument("tables", nargs="*", help=f"таблицы, по умолчанию все: {', '.join(EXPORT_TABLES)}")
+    parser.add_argument("--format", choices=list(FORMATS), default="ndjson")
+    parser.add_argument("--since", help="выгрузить только строки с водяным знаком новее этого")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--out", default=".", help="каталог для файлов")
+    args = parser.parse_args()
+
+    tables = args.tables or [t for t in EXPORT_TABLES if args.since is None or EXPORT_TABLES[t]]
+    os.makedirs(args.out, exist_ok=True)
+    for table in tables:
+        path = os.path.join(args.out, export_filename(table, args.format, args.gzip))
+        stats = {}
+        try:
+            with open(path, "wb") as f:
+                for chunk in export_stream(args.db, table, args.format, args.since, args.gzip, stats):
+                    f.write(chunk)
+        except (ValueError, sqlite3.Error) as e:
+            print(f"❌ {table}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"✅ {table}: {stats['rows']} строк -> {path}, водяной знак {stats['watermark']}")
+
+
+if __name__ == "__main__":
+    main()
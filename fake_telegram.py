@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Локальный фейковый Telegram Bot API для нагрузочных тестов.
+
+Бот запускается с TELEGRAM_API_URL=http://localhost:8081, и все его вызовы
+попадают сюда: записываются с временем и могут получать искусственную
+задержку, 429 с retry_after и 5xx.
+
+    python fake_telegram.py --port 8081 --latency-ms 30 --rate-429 0.01 --rate-5xx 0.01
+"""
+
+import argparse
+import logging
+import random
+import threading
+import time
+
+from flask import Flask, request
+
+app = Flask(__name__)
+
+config = {
+    "latency_ms": 0.0,
+    "rate_429": 0.0,
+    "retry_after": 1,
+    "rate_5xx": 0.0,
+}
+
+calls_lock = threading.Lock()
+calls = []  # {"ts", "token", "method", "chat_id", "status", "payload"}
+calls_by_chat = {}  # chat_id -> [вызовы этого чата]
+message_ids = {}  # chat_id -> последний message_id
+
+
+def record_call(token, method, payload, status):
+    entry = {
+        "ts": time.time(),
+        "token": token,
+        "method": method,
+        "chat_id": payload.get("chat_id"),
+        "status": status,
+        "payload": payload,
+    }
+    with calls_lock:
+        calls.append(entry)
+        calls_by_chat.setdefault(str(entry["chat_id"]), []).append(entry)
+    return entry
+
+
+def get_calls(since=0):
+    """Вызовы, начиная с индекса since"""
+    with calls_lock:
+        return calls[since:]
+
+
+def get_chat_calls(chat_id):
+    with calls_lock:
+        return list(calls_by_chat.get(str(chat_id), []))
+
+
+def reset_calls():
+    with calls_lock:
+        calls.clear()
+        calls_by_chat.clear()
+        message_ids.clear()
+
+
+def next_message_id(chat_id):
+    with calls_lock:
+        message_ids[chat_id] = message_ids.get(chat_id, 0) + 1
+        return message_ids[chat_id]
+
+
+@app.route("/bot<token>/<method>", methods=["GET", "POST"])
+def bot_api(token, method):
+    payload = request.get_json(silent=True) or request.form.to_dict() or {}
+
+    if config["latency_ms"]:
+        time.sleep(config["latency_ms"] / 1000 * random.uniform(0.5, 1.5))
+
+    roll = random.random()
+    if roll < config["rate_429"]:
+        record_call(token, method, payload, 429)
+        return {
+            "ok": False,
+            "error_code": 429,
+            "description": "Too Many Requests: retry after %d" % config["retry_after"],
+            "parameters": {"retry_after": config["retry_after"]},
+        }, 429
+    if roll < config["rate_429"] + config["rate_5xx"]:
+        record_call(token, method, payload, 502)
+        return {"ok": False, "error_code": 502, "description": "Bad Gateway"}, 502
+
+    if method in ("sendMessage", "editMessageText"):
+        chat_id = payload.get("chat_id")
+        message_id = payload.get("message_id") or next_message_id(chat_id)
+        record_call(token, method, payload, 200)["message_id"] = message_id
+        return {
+            "ok": True,
+            "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": payload.get("text", ""),
+            },
+        }, 200
+    record_call(token, method, payload, 200)
+    return {"ok": True, "result": True}, 200
+
+
+@app.route("/_calls", methods=["GET"])
+def calls_endpoint():
+    since = request.args.get("since", 0, type=int)
+    return {"calls": get_calls(since)}, 200
+
+
+@app.route("/_reset", methods=["POST"])
+def reset_endpoint():
+    reset_calls()
+    return {"ok": True}, 200
+
+
+def serve(port, threaded_start=False):
+    """Запускает сервер; с threaded_start=True - в фоновом потоке"""
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    if threaded_start:
+        thread = threading.Thread(
+            target=app.run,
+            kwargs={"host": "127.0.0.1", "port": port, "threaded": True},
+            daemon=True,
+        )
+        thread.start()
+        return thread
+    app.run(host="127.0.0.1", port=port, threaded=True)
+
+
+def configure(latency_ms=0.0, rate_429=0.0, retry_after=1, rate_5xx=0.0):
+    config.update(latency_ms=latency_ms, rate_429=rate_429, retry_after=retry_after, rate_5xx=rate_5xx)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    args = parser.parse_args()
+    configure(args.latency_ms, args.rate_429, args.retry_after, args.rate_5xx)
+    print(f"🤖 Фейковый Bot API на http://127.0.0.1:{args.port}")
+    serve(args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Сквозной нагрузочный тест бота через фейковый Telegram Bot API.
+
+Поднимает fake_telegram.py в фоне и гоняет по /webhook бота реалистичные
+сессии: /start, имя, ингредиенты, выбор рецепта и шаги кнопкой "Далее".
+Латентность апдейта - от отправки до последнего ответа бота в этот чат.
+
+Бот запускается отдельно и смотрит на фейк:
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081 RATE_LIMIT_BURST=1000 python main.py
+    python load_harness.py --bot-url http://127.0.0.1:10000 --users 20 --sessions 3
+
+С --tenants a,b пользователи раскладываются по вебхукам /webhook/a и /webhook/b.
+"""
+
+import argparse
+import itertools
+import random
+import threading
+import time
+
+import requests
+
+import fake_telegram
+
+NAMES = ["Анна", "Мария", "Дмитрий", "Иван", "Ольга", "Сергей", "Наташа", "Миша"]
+FRIDGES = [
+    "макароны, яйца, бекон, сыр_пармезан, чеснок, соль",
+    "говядина, свекла, капуста, морковь, лук, картофель, томаты, чеснок",
+    "рис, мясо, морковь, лук, чеснок, соль, перец",
+    "мука, молоко, яйца, сахар, соль, дрожжи, растительное_масло",
+]
+NEXT_WORDS = ["далее", "дальше", "готово", "продолжаем"]
+
+update_ids = itertools.count(1)
+results_lock = threading.Lock()
+results = {"latencies": [], "updates": 0, "webhook_errors": 0, "no_reply": 0}
+
+
+def make_message(chat_id, text):
+    return {
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "username": f"load{chat_id}"},
+            "text": text,
+        },
+    }
+
+
+def make_callback(chat_id, data, message_id=1):
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": {"id": chat_id},
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            },
+        },
+    }
+
+
+def callback_buttons(call):
+    markup = call["payload"].get("reply_markup") or {}
+    return [b.get("callback_data", "") for row in markup.get("inline_keyboard", []) for b in row]
+
+
+def send_update(session, webhook_url, chat_id, update, quiet_ms, timeout):
+    """Шлет апдейт и ждет, пока бот перестанет отвечать в чат"""
+    seen = len(fake_telegram.get_chat_calls(chat_id))
+    started = time.time()
+    try:
+        resp = session.post(webhook_url, json=update, timeout=timeout)
+        ok = resp.status_code == 200
+    except requests.RequestException:
+        ok = False
+
+    # Вебхук отвечает сразу, ответы идут из воркера: ждем первый ответ
+    # до timeout, а после него - пока в чате не станет тихо на quiet_ms
+    last_reply = None
+    quiet_since = time.time()
+    while time.time() - started < timeout:
+        calls = fake_telegram.get_chat_calls(chat_id)
+        if len(calls) > seen:
+            last_reply = calls[-1]["ts"]
+            seen = len(calls)
+            quiet_since = time.time()
+        elif last_reply is not None and time.time() - quiet_since >= quiet_ms / 1000:
+            break
+        time.sleep(0.005)
+
+    with results_lock:
+        results["updates"] += 1
+        if not ok:
+            results["webhook_errors"] += 1
+        if last_reply is None:
+            results["no_reply"] += 1
+        else:
+            results["latencies"].append(last_reply - started)
+    return fake_telegram.get_chat_calls(chat_id)
+
+
+def run_session(session, args, chat_id, webhook_url):
+    step = lambda update: send_update(session, webhook_url, chat_id, update, args.quiet_ms, args.timeout)
+
+    step(make_message(chat_id, "/start"))
+    step(make_message(chat_id, random.choice(NAMES)))
+    calls = step(make_message(chat_id, random.choice(FRIDGES)))
+
+    recipes = [data for call in calls for data in callback_buttons(call) if data.startswith("recipe_")]
+    if not recipes:
+        return
+    calls = step(make_callback(chat_id, recipes[-1]))
+
+    # Листаем шаги кнопкой "Далее" в том же сообщении, без кнопок - текстом
+    for _ in range(args.steps):
+        buttons = [(call, callback_buttons(call)) for call in calls if callback_buttons(call)]
+        if buttons and not buttons[-1][1][-1].startswith("recipe_"):
+            call, data = buttons[-1]
+            calls = step(make_callback(chat_id, data[-1], call.get("message_id", 1)))
+            if data[-1].startswith("done:"):
+                break
+        else:
+            calls = step(make_message(chat_id, random.choice(NEXT_WORDS)))
+
+
+def run_user(args, chat_id, webhook_url):
+    with requests.Session() as session:
+        for _ in range(args.sessions):
+            run_session(session, args, chat_id, webhook_url)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def report(elapsed):
+    calls = fake_telegram.get_calls()
+    api_errors = sum(1 for c in calls if c["status"] != 200)
+    api_429 = sum(1 for c in calls if c["status"] == 429)
+    latencies = results["latencies"]
+    updates = results["updates"]
+
+    print("=" * 50)
+    print(f"📨 Апдейтов: {updates} за {elapsed:.1f} сек -> {updates / elapsed:.1f} апдейт/сек")
+    print(f"⏱️  p50: {percentile(latencies, 50) * 1000:.0f} мс, p99: {percentile(latencies, 99) * 1000:.0f} мс")
+    print(f"❌ Ошибки webhook: {results['webhook_errors'] / max(updates, 1):.2%}")
+    print(f"🙊 Без ответа: {results['no_reply'] / max(updates, 1):.2%}")
+    print(f"🤖 Вызовов Bot API: {len(calls)}, ошибок {api_errors / max(len(calls), 1):.2%} (из них 429: {api_429})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    parser.add_argument("--bot-url", default="http://127.0.0.1:10000")
+    parser.add_argument("--fake-port", type=int, default=8081)
+    parser.add_argument("--tenants", default="", help="имена тенантов через запятую, по умолчанию /webhook")
+    parser.add_argument("--users", type=int, default=10, help="параллельных пользователей")
+    parser.add_argument("--sessions", type=int, default=1, help="сессий готовки на пользователя")
+    parser.add_argument("--steps", type=int, default=5, help="сколько раз нажать 'Далее'")
+    parser.add_argument("--quiet-ms", type=float, default=100, help="тишина, после которой ответ считается полным")
+    parser.add_argument("--timeout", type=float, default=5, help="сколько ждать первого ответа")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake_telegram.configure(args.latency_ms, args.rate_429, 1, args.rate_5xx)
+    fake_telegram.serve(args.fake_port, threaded_start=True)
+    time.sleep(0.5)
+    print(f"🚀 {args.users} пользователей x {args.sessions} сессий -> {args.bot_url}")
+
+    tenants = [t for t in args.tenants.split(",") if t]
+    webhooks = [f"{args.bot_url}/webhook/{t}" for t in tenants] or [f"{args.bot_url}/webhook"]
+
+    started = time.time()
+    threads = [
+        threading.Thread(target=run_user, args=(args, 900000000 + i, webhooks[i % len(webhooks)]))
+        for i in range(args.users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(time.time() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,29 @@ import logging
 import json
 import time
 import hashlib
+import hmac
+import heapq
+import itertools
+import zlib
 import re
-from datetime import datetime
+import bisect
+import random
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, wraps
+import threading
+import queue
+from concurrent.futures import Future
+from datetime import datetime, timedelta
 import sqlite3
 import requests
-from flask import Flask, request
+from flask import Flask, Response, request
+
+from recipe_snapshot import RecipeSnapshot, build_prefix_index, index_tokens, load_recipes_json
+from recipe_vectors import RecipeMatrix
+from meal_planner import MealPlanner
+from export_db import EXPORT_TABLES, FORMATS, export_filename, export_stream
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,13 +36,73 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TENANTS_FILE = os.getenv("TENANTS_FILE")  # несколько ботов в одном процессе, см. tenants.example.json
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 DB_PATH = os.getenv("DB_PATH", "bot.db")
+RECIPES_FILE = os.getenv("RECIPES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipes.json"))
+RECIPES_SNAPSHOT = os.getenv("RECIPES_SNAPSHOT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipes.snap"))
+PERSONA_FILE = os.getenv("PERSONA_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "persona.json"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+DAU_RETENTION_DAYS = int(os.getenv("DAU_RETENTION_DAYS", "30"))  # сколько дней хранить daily_active, счетчики DAU остаются
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений в секунду, лимит Telegram ~30
+BROADCAST_MAX_TEXT = 4096  # лимит Telegram на текст сообщения; MAX_TEXT_LENGTH к рассылке не относится
+
+# Admission control
+RATE_LIMIT_PER_SEC = float(os.getenv("RATE_LIMIT_PER_SEC", "1"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "5"))
+MAX_TEXT_LENGTH = int(os.getenv("MAX_TEXT_LENGTH", "1000"))
+MAX_UPDATE_AGE = int(os.getenv("MAX_UPDATE_AGE", "300"))
+LOAD_SHED_LATENCY_MS = float(os.getenv("LOAD_SHED_LATENCY_MS", "5000"))
+
+# Durable inbox/outbox
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+
+# Bot API client: timeouts, per-update budget, retries and circuit breaker
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "3.05"))
+API_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "10"))
+API_RETRIES = int(os.getenv("API_RETRIES", "2"))  # только для идемпотентных методов
+UPDATE_BUDGET_MS = float(os.getenv("UPDATE_BUDGET_MS", "8000"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+# Cooking timers
+TIMER_SENDERS = int(os.getenv("TIMER_SENDERS", "2"))  # потоков, отправляющих напоминания
+TIMER_MAX_SECONDS = 24 * 3600
+
+# Group commit of DB writes
+DB_BATCH_MS = float(os.getenv("DB_BATCH_MS", "5"))
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "100"))
+
+# Tracing and profiling (off by default)
+TRACE_FILE = os.getenv("TRACE_FILE")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "2"))
+
+# Recipe matching
+MATCH_ENGINE = os.getenv("MATCH_ENGINE", "matrix")  # "matrix" - матрица рецепт x ингредиент, "sets" - перебор множеств
+SIMILAR_TOP_K = int(os.getenv("SIMILAR_TOP_K", "5"))
+
+# Meal planner
+PLAN_DISHES = int(os.getenv("PLAN_DISHES", "3"))  # блюд в плане по умолчанию
+PLAN_MAX_DISHES = 5
+PLAN_BUDGET_MS = int(os.getenv("PLAN_BUDGET_MS", "300"))  # сколько искать лучший план, дальше - лучший найденный
+PLAN_CANDIDATES = int(os.getenv("PLAN_CANDIDATES", "300"))  # рецептов-кандидатов в переборе
+
+# Full-text search over recipes
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "3"))  # сколько рецептов показывать в ответе на вопрос
+
+# Inline mode
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_PAGE_SIZE = 20
 
 # Better error handling for missing environment variables
 def check_env_vars():
     missing_vars = []
-    if not BOT_TOKEN:
+    if not BOT_TOKEN and not TENANTS_FILE:
         missing_vars.append("BOT_TOKEN")
     if not WEBHOOK_URL:
         missing_vars.append("WEBHOOK_URL")
@@ -46,16 +124,365 @@ app = Flask(__name__)
 processed_messages = set()
 processed_callback_ids = set()
 
+# --- Admission control ---
+admission_lock = threading.Lock()
+admission_stats = {
+    "rate_limited": 0,
+    "text_truncated": 0,
+    "stale_dropped": 0,
+    "stale_notified": 0,
+    "load_shed": 0,
+}
+user_buckets = {}  # user_id -> (tokens, last_refill)
+BUCKET_SWEEP_INTERVAL = 60  # сек между чистками полных корзин
+buckets_swept_at = 0.0
+stale_notified_chats = set()
+queue_latency_ewma = 0.0
+
+def count_admission(event):
+    with admission_lock:
+        admission_stats[event] += 1
+
+def take_token(user_id, now=None):
+    """Token bucket на пользователя: True, если апдейт можно обработать"""
+    if user_id is None:
+        return True
+    global buckets_swept_at
+    now = time.monotonic() if now is None else now
+    with admission_lock:
+        if now - buckets_swept_at >= BUCKET_SWEEP_INTERVAL:
+            # Полная корзина ничем не отличается от отсутствующей - выкидываем,
+            # иначе словарь растет с каждым пользователем, которого видел процесс
+            buckets_swept_at = now
+            for uid, (tokens, last) in list(user_buckets.items()):
+                if tokens + (now - last) * RATE_LIMIT_PER_SEC >= RATE_LIMIT_BURST:
+                    del user_buckets[uid]
+        tokens, last = user_buckets.get(user_id, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * RATE_LIMIT_PER_SEC)
+        if tokens < 1:
+            user_buckets[user_id] = (tokens, now)
+            return False
+        user_buckets[user_id] = (tokens - 1, now)
+        return True
+
+def record_queue_latency(seconds):
+    """Сколько апдейт ждал воркера; по этой задержке сбрасываем нагрузку"""
+    global queue_latency_ewma
+    with admission_lock:
+        queue_latency_ewma = 0.8 * queue_latency_ewma + 0.2 * seconds * 1000
+
+def is_overloaded():
+    return queue_latency_ewma > LOAD_SHED_LATENCY_MS
+
+def clip_text(text):
+    """Обрезает слишком длинный текст до MAX_TEXT_LENGTH"""
+    if len(text) > MAX_TEXT_LENGTH:
+        count_admission("text_truncated")
+        logger.info(f"✂️ Текст обрезан: {len(text)} -> {MAX_TEXT_LENGTH}")
+        return text[:MAX_TEXT_LENGTH]
+    return text
+
+def update_identity(data):
+    """(user_id, chat_id, message) апдейта любого типа"""
+    if "inline_query" in data:
+        return data["inline_query"].get("from", {}).get("id"), None, {}
+    if "callback_query" in data:
+        cb = data["callback_query"]
+        msg = cb.get("message", {})
+        user_id = cb.get("from", {}).get("id")
+    else:
+        msg = data.get("message", {})
+        user_id = msg.get("from", {}).get("id")
+    return user_id, msg.get("chat", {}).get("id"), msg
+
+def drop_stale(data):
+    """Отсекает сообщение старше MAX_UPDATE_AGE: и с вебхука, и при переигрывании inbox"""
+    user_id, chat_id, msg = update_identity(data)
+    date = msg.get("date")
+    if "message" in data and date and time.time() - date > MAX_UPDATE_AGE:
+        count_admission("stale_dropped")
+        logger.info(f"⌛ Пропускаем устаревший апдейт от {user_id}")
+        # Один ответ на весь накопившийся бэклог чата
+        if chat_id is not None and chat_id not in stale_notified_chats:
+            stale_notified_chats.add(chat_id)
+            count_admission("stale_notified")
+            dispatch_reply(data, "sendMessage", {
+                "chat_id": chat_id,
+                "text": "Блять, я тут отходил ненадолго! Что пропустил - повтори, или напиши /start! 👨‍🍳",
+            })
+        return True
+    if chat_id is not None:
+        stale_notified_chats.discard(chat_id)
+    return False
+
+def admit_update(data):
+    """Решает, обрабатывать ли апдейт: устаревшие, флуд и перегрузка отсекаются.
+    Ответы на отсеянные апдейты уходят через воркер, вебхук не ждет Bot API"""
+    if "inline_query" in data:
+        # Inline-запросы приходят на каждое нажатие клавиши и не трогают БД,
+        # поэтому токены на них не тратим
+        if is_overloaded():
+            count_admission("load_shed")
+            record_queue_latency(0)
+            return False
+        return True
+    if drop_stale(data):
+        return False
+    user_id, _, _ = update_identity(data)
+
+    if is_overloaded():
+        count_admission("load_shed")
+        # Сброшенный апдейт тянет среднее вниз, иначе из перегрузки не выйти
+        record_queue_latency(0)
+        logger.warning(f"🚦 Перегрузка ({queue_latency_ewma:.0f} мс), апдейт сброшен")
+        return False
+
+    if not take_token(user_id):
+        count_admission("rate_limited")
+        logger.info(f"🚫 Флуд от пользователя {user_id}")
+        if "callback_query" in data and data["callback_query"].get("id"):
+            # Без ответа у пользователя вечно крутятся часики на кнопке
+            dispatch_reply(data, "answerCallbackQuery", {
+                "callback_query_id": data["callback_query"]["id"],
+                "text": "Не так быстро! Подожди секунду ✋",
+            })
+        return False
+    return True
+
+# --- Tracing ---
+# Спаны пишутся в TRACE_FILE по одной строке OTLP JSON на апдейт.
+# Без TRACE_FILE декоратор traced возвращает функцию как есть - накладных расходов нет.
+trace_local = threading.local()
+trace_file_lock = threading.Lock()
+
+def new_span_id(nbytes=8):
+    return os.urandom(nbytes).hex()
+
+@contextmanager
+def span(name, **attributes):
+    trace = getattr(trace_local, "trace", None)
+    if trace is None:
+        yield
+        return
+    span_id = new_span_id()
+    parent = trace["stack"][-1] if trace["stack"] else ""
+    trace["stack"].append(span_id)
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        trace["stack"].pop()
+        trace["spans"].append({
+            "traceId": trace["trace_id"],
+            "spanId": span_id,
+            "parentSpanId": parent,
+            "name": name,
+            "kind": 1,
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(time.time_ns()),
+            "attributes": [
+                {"key": k, "value": {"stringValue": str(v)}} for k, v in attributes.items()
+            ],
+        })
+
+def traced(fn):
+    """Оборачивает функцию в спан, если трассировка включена"""
+    if not TRACE_FILE:
+        return fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def trace_request(name, **attributes):
+    """Корневой спан апдейта; по выходу трасса дописывается в TRACE_FILE"""
+    trace_local.trace = {"trace_id": new_span_id(16), "stack": [], "spans": []}
+    try:
+        with span(name, **attributes):
+            yield
+    finally:
+        trace = trace_local.trace
+        trace_local.trace = None
+        export_trace(trace["spans"])
+
+def export_trace(spans):
+    record = {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "cooking-bot"}}]},
+            "scopeSpans": [{"scope": {"name": "main"}, "spans": spans}],
+        }]
+    }
+    try:
+        line = json.dumps(record, ensure_ascii=False)
+        with trace_file_lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except Exception:
+        logger.exception("💥 Ошибка записи трассы")
+
+# --- Sampling profiler ---
+def should_profile():
+    # Заголовок принимаем только с админским токеном, иначе любой, кто может
+    # слать на /webhook, запускает профайлер и пишет файлы на каждый запрос
+    if request.headers.get("X-Debug-Profile") and is_admin_request():
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def folded_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+@contextmanager
+def profile_request(label):
+    """Сэмплирует стек текущего потока и пишет его в формате folded stacks для flamegraph"""
+    thread_id = threading.get_ident()
+    samples = {}
+    stop = threading.Event()
+
+    def sampler():
+        while not stop.wait(PROFILE_INTERVAL_MS / 1000):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                key = folded_stack(frame)
+                samples[key] = samples.get(key, 0) + 1
+
+    thread = threading.Thread(target=sampler, name="profiler", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{label}.folded")
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in samples.items():
+                    f.write(f"{stack} {count}\n")
+            logger.info(f"🔬 Профиль сохранен: {path}")
+        except Exception:
+            logger.exception("💥 Ошибка записи профиля")
+
 # --- Database helpers ---
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    # Read-your-writes: сначала дожидаемся своих записей в очереди писателя
+    wait_for_writes()
+    conn = sqlite3.connect(current_tenant()["db_path"])
     conn.row_factory = sqlite3.Row
     return conn
 
+# --- Single-writer DB thread ---
+# Все записи идут через один поток, который коммитит их пачками:
+# один fsync на пачку вместо одного на запись и никаких "database is locked".
+# У каждого тенанта своя БД: запись уходит в БД тенанта, который ее поставил.
+write_queue = queue.Queue()
+writer_lock = threading.Lock()
+writer_thread = None
+pending_writes = threading.local()
+
+def db_write(fn, *args):
+    """Ставит запись fn(cur, *args) в очередь писателя и возвращает Future"""
+    ensure_writer()
+    future = Future()
+    write_queue.put((current_tenant()["db_path"], fn, args, future))
+    pending_writes.last = future
+    return future
+
+def wait_for_writes():
+    """Ждет, пока закоммитятся записи, поставленные этим потоком"""
+    future = getattr(pending_writes, "last", None)
+    if future is not None:
+        pending_writes.last = None
+        try:
+            future.result()
+        except Exception:
+            pass  # ошибка уже залогирована писателем
+
+def ensure_writer():
+    global writer_thread
+    if writer_thread is not None and writer_thread.is_alive():
+        return
+    with writer_lock:
+        if writer_thread is None or not writer_thread.is_alive():
+            writer_thread = threading.Thread(target=writer_loop, name="db-writer", daemon=True)
+            writer_thread.start()
+
+def writer_loop():
+    conns = {}  # db_path -> соединение писателя
+    while True:
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + DB_BATCH_MS / 1000
+        while len(batch) < DB_BATCH_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(write_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        by_db = {}
+        for db_path, fn, args, future in batch:
+            by_db.setdefault(db_path, []).append((fn, args, future))
+        for db_path, writes in by_db.items():
+            # Ошибка одной БД не должна убить писателя: ее записи получают исключение,
+            # остальные тенанты пишутся дальше
+            try:
+                if db_path not in conns:
+                    conn = sqlite3.connect(db_path, isolation_level=None)
+                    conn.row_factory = sqlite3.Row
+                    conns[db_path] = conn
+                conn = conns[db_path]
+                commit_batch(conn, conn.cursor(), writes)
+            except Exception as e:
+                logger.exception(f"💥 Писатель не может работать с БД {db_path}")
+                stale = conns.pop(db_path, None)
+                if stale is not None:
+                    stale.close()
+                for _, _, future in writes:
+                    if not future.done():
+                        future.set_exception(e)
+
+def commit_batch(conn, cur, batch):
+    results = []
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        for fn, args, future in batch:
+            # Savepoint на каждую запись: ошибка одной не откатывает остальные
+            cur.execute("SAVEPOINT op")
+            try:
+                results.append((future, fn(cur, *args), None))
+                cur.execute("RELEASE op")
+            except Exception as e:
+                logger.exception(f"💥 Ошибка записи в БД ({fn.__name__})")
+                cur.execute("ROLLBACK TO op")
+                cur.execute("RELEASE op")
+                results.append((future, None, e))
+        cur.execute("COMMIT")
+    except Exception as e:
+        logger.exception("💥 Ошибка коммита пачки записей")
+        if conn.in_transaction:
+            conn.rollback()
+        for _, _, future in batch:
+            future.set_exception(e)
+        return
+    for future, result, error in results:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
 def init_db():
     try:
         conn = get_db()
         cur = conn.cursor()
+        # WAL: чтения не блокируются писателем
+        cur.execute("PRAGMA journal_mode=WAL")
         # users
         cur.execute(
             """
@@ -78,30 +505,136 @@ def init_db():
             )
             """
         )
-        conn.commit()
-        conn.close()
-    except Exception:
-        logger.exception("💥 Ошибка инициализации БД")
-
-def upsert_user(user_id, username, gender=None):
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        if gender:
-            cur.execute(
-                "INSERT OR REPLACE INTO users (user_id, username, gender, created_at) VALUES (?, ?, ?, ?)",
-                (str(user_id), username, gender, datetime.utcnow().isoformat())
+        # users who blocked the bot are skipped by broadcasts
+        cur.execute("PRAGMA table_info(users)")
+        user_columns = [row["name"] for row in cur.fetchall()]
+        if "blocked" not in user_columns:
+            cur.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+        # updated_at: watermark for incremental exports
+        if "updated_at" not in user_columns:
+            cur.execute("ALTER TABLE users ADD COLUMN updated_at TEXT")
+            cur.execute("UPDATE users SET updated_at = created_at")
+        # broadcast jobs with resume checkpoint
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                last_user_id TEXT NOT NULL DEFAULT '',
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                started_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
             )
-        else:
+            """
+        )
+        # inbox: updates are stored before the ack and marked done after processing
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS inbox (
+                update_id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                received_at TEXT NOT NULL
+            )
+            """
+        )
+        # outbox: Bot API calls that failed and wait for a retry
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                method TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
+        # pantry: what each user has at home, changed by "добавь"/"убери"
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pantry (
+                user_id TEXT NOT NULL,
+                ingredient TEXT NOT NULL,
+                added_at TEXT NOT NULL,
+                PRIMARY KEY (user_id, ingredient)
+            )
+            """
+        )
+        # pre-aggregated counters, updated at write time
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'")
+        counters_existed = cur.fetchone() is not None
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+            """
+        )
+        if not counters_existed:
+            # existing database: start stage counters from the sessions already there
             cur.execute(
-                "INSERT OR IGNORE INTO users (user_id, username, created_at) VALUES (?, ?, ?)",
-                (str(user_id), username, datetime.utcnow().isoformat())
+                "INSERT INTO stats_counters (key, value) SELECT 'stage:' || stage, COUNT(*) FROM cooking_sessions GROUP BY stage"
+            )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_active (
+                day TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                PRIMARY KEY (day, user_id)
             )
+            """
+        )
+        # cooking timers: one pending reminder per chat, resumed after restart
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS timers (
+                chat_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                recipe_id TEXT NOT NULL,
+                step INTEGER NOT NULL,
+                seconds INTEGER NOT NULL,
+                due_at REAL NOT NULL,
+                name TEXT,
+                gender TEXT
+            )
+            """
+        )
         conn.commit()
+        try:
+            create_search_tables(cur)
+            conn.commit()
+        except sqlite3.OperationalError:
+            logger.exception("⚠️ FTS5 недоступен, полнотекстовый поиск выключен")
         conn.close()
     except Exception:
-        logger.exception("💥 Ошибка записи пользователя")
+        logger.exception("💥 Ошибка инициализации БД")
 
+def upsert_user(user_id, username, gender=None):
+    return db_write(write_user, user_id, username, gender)
+
+def write_user(cur, user_id, username, gender):
+    now = datetime.utcnow().isoformat()
+    if gender:
+        cur.execute(
+            "INSERT OR REPLACE INTO users (user_id, username, gender, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (str(user_id), username, gender, now, now)
+        )
+    else:
+        cur.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (str(user_id), username, now, now)
+        )
+    record_activity(cur, user_id)
+
+@traced
 def get_user(user_id):
     conn = get_db()
     cur = conn.cursor()
@@ -110,6 +643,7 @@ def get_user(user_id):
     conn.close()
     return dict(row) if row else None
 
+@traced
 def get_session(user_id):
     conn = get_db()
     cur = conn.cursor()
@@ -122,45 +656,272 @@ def get_session(user_id):
     return {"stage": stage, "data": json.loads(data_json) if data_json else {}}
 
 def save_session(user_id, stage, data):
-    conn = get_db()
-    cur = conn.cursor()
+    if stage != "cooking":
+        forget_cook(user_id)  # кэш шагов живет, только пока сессия на этапе готовки
+    return db_write(write_session, user_id, stage, data)
+
+def write_session(cur, user_id, stage, data):
+    cur.execute("SELECT stage FROM cooking_sessions WHERE user_id=?", (str(user_id),))
+    row = cur.fetchone()
     cur.execute(
         "REPLACE INTO cooking_sessions (user_id, stage, data_json, updated_at) VALUES (?, ?, ?, ?)",
         (str(user_id), stage, json.dumps(data, ensure_ascii=False), datetime.utcnow().isoformat())
     )
-    conn.commit()
+    record_stage_change(cur, row["stage"] if row else None, stage)
+
+# --- Usage statistics ---
+FUNNEL_STAGES = ["ask_name", "ask_ingredients", "show_recipes", "cooking", "done"]
+
+def bump_counter(cur, key, delta=1):
+    cur.execute(
+        "INSERT INTO stats_counters (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+        (key, delta)
+    )
+
+def record_activity(cur, user_id):
+    """Считает пользователя в DAU один раз за день"""
+    day = datetime.utcnow().date().isoformat()
+    cur.execute("INSERT OR IGNORE INTO daily_active (day, user_id) VALUES (?, ?)", (day, str(user_id)))
+    if cur.rowcount == 1:
+        bump_counter(cur, f"dau:{day}")
+        # Старые дни нужны только для выгрузки; DELETE по первичному ключу дешевый, когда удалять нечего
+        cutoff = (datetime.utcnow().date() - timedelta(days=DAU_RETENTION_DAYS)).isoformat()
+        cur.execute("DELETE FROM daily_active WHERE day < ?", (cutoff,))
+
+def record_stage_change(cur, old_stage, new_stage):
+    """Обновляет число сессий на этапе и воронку при смене этапа"""
+    if old_stage == new_stage:
+        return
+    if old_stage:
+        bump_counter(cur, f"stage:{old_stage}", -1)
+    bump_counter(cur, f"stage:{new_stage}")
+    bump_counter(cur, f"funnel:{new_stage}")
+
+def increment_counter(key, delta=1):
+    return db_write(bump_counter, key, delta)
+
+def get_stats(days=7):
+    """Собирает статистику из готовых счетчиков, без COUNT(*) по таблицам"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT key, value FROM stats_counters WHERE key NOT LIKE 'dau:%'")
+    counters = {row["key"]: row["value"] for row in cur.fetchall()}
+    cur.execute(
+        "SELECT key, value FROM stats_counters WHERE key LIKE 'dau:%' ORDER BY key DESC LIMIT ?",
+        (days,)
+    )
+    dau = {row["key"][4:]: row["value"] for row in cur.fetchall()}
     conn.close()
 
-# --- UI helpers ---
-def send_message(chat_id, text, reply_markup=None):
+    def group(prefix):
+        return {k[len(prefix):]: v for k, v in counters.items() if k.startswith(prefix)}
+
+    funnel = group("funnel:")
+    dropoff = {}
+    for prev, nxt in zip(FUNNEL_STAGES, FUNNEL_STAGES[1:]):
+        entered = funnel.get(prev, 0)
+        dropoff[f"{prev}->{nxt}"] = round(1 - funnel.get(nxt, 0) / entered, 3) if entered else None
+
+    return {
+        "daily_active_users": dau,
+        "sessions_per_stage": group("stage:"),
+        "funnel": {stage: funnel.get(stage, 0) for stage in FUNNEL_STAGES},
+        "funnel_dropoff": dropoff,
+        "recipe_selections": group("recipe:"),
+        "gender_fallbacks": counters.get("gender_fallback", 0),
+    }
+
+def format_stats(stats):
+    lines = ["📊 Статистика бати:", "", "DAU:"]
+    lines += [f"• {day}: {n}" for day, n in stats["daily_active_users"].items()] or ["• нет данных"]
+    lines += ["", "Сессии по этапам:"]
+    lines += [f"• {stage}: {n}" for stage, n in stats["sessions_per_stage"].items()]
+    lines += ["", "Воронка:"]
+    lines += [f"• {stage}: {n}" for stage, n in stats["funnel"].items()]
+    lines += [f"• отвал {step}: {'—' if rate is None else f'{rate:.0%}'}" for step, rate in stats["funnel_dropoff"].items()]
+    lines += ["", "Выбор рецептов:"]
+    lines += [f"• {RECIPES.get(rid, {}).get('name', rid)}: {n}" for rid, n in stats["recipe_selections"].items()]
+    lines += ["", f"Пол по умолчанию (не распознан): {stats['gender_fallbacks']}"]
+    return "\n".join(lines)
+
+def is_admin_chat(chat_id):
+    admin_chat_id = current_tenant()["admin_chat_id"]
+    return bool(admin_chat_id) and str(chat_id) == str(admin_chat_id)
+
+def is_admin_request():
+    # Только заголовок: токен из URL оседает в логах доступа и прокси
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+# --- Bot API client ---
+# Все вызовы Bot API идут через call_api: раздельные таймауты на соединение и чтение,
+# бюджет времени на апдейт и предохранитель. Когда Telegram тормозит или лежит,
+# предохранитель размыкается, и вызовы сразу уходят в outbox, не занимая воркеры.
+IDEMPOTENT_METHODS = {"editMessageText", "answerCallbackQuery", "answerInlineQuery", "setWebhook", "getMe"}
+API_RETRY_BASE = 0.2  # секунды, база для джиттера между повторами
+breaker_lock = threading.Lock()
+breaker = {"state": "closed", "failures": 0, "opened_at": 0.0, "probing": False}
+api_stats = {"calls": 0, "failures": 0, "retries": 0, "short_circuited": 0, "over_budget": 0, "opened": 0}
+api_deadline = threading.local()
+# Один пул соединений к Bot API на все тенанты
+api_session = requests.Session()
+api_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPDATE_WORKERS + 4))
+api_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPDATE_WORKERS + 4))
+
+def api_url(method):
+    return f"{TELEGRAM_API_URL}/bot{current_tenant()['token']}/{method}"
+
+@contextmanager
+def api_budget(ms):
+    """Ограничивает суммарное время вызовов Bot API в этом потоке"""
+    api_deadline.at = time.monotonic() + ms / 1000
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        data = {"chat_id": chat_id, "text": text}
-        if reply_markup:
-            data["reply_markup"] = reply_markup
-        
-        logger.info(f"📤 Отправляем сообщение в чат {chat_id}: {text[:50]}...")
-        response = requests.post(url, json=data, timeout=10)
-        
-        if not response.ok:
-            logger.error(f"❌ Ошибка отправки сообщения: {response.status_code} - {response.text}")
-        else:
-            logger.info(f"✅ Сообщение отправлено успешно")
-    except Exception as e:
-        logger.exception(f"💥 Ошибка отправки сообщения: {e}")
+        yield
+    finally:
+        api_deadline.at = None
 
-def answer_callback_query(callback_query_id, text=None):
+def budget_left():
+    deadline = getattr(api_deadline, "at", None)
+    return float("inf") if deadline is None else deadline - time.monotonic()
+
+def count_api(event):
+    with breaker_lock:
+        api_stats[event] += 1
+
+def breaker_open():
+    """Разомкнут и еще остывает: вызовы не пропускаются"""
+    with breaker_lock:
+        return breaker["state"] == "open" and time.monotonic() - breaker["opened_at"] < BREAKER_COOLDOWN
+
+def breaker_allow():
+    with breaker_lock:
+        if breaker["state"] == "open":
+            if time.monotonic() - breaker["opened_at"] < BREAKER_COOLDOWN:
+                return False
+            breaker.update(state="half_open", probing=False)
+        if breaker["state"] == "half_open":
+            if breaker["probing"]:
+                return False
+            breaker["probing"] = True  # после остывания пропускаем один пробный вызов
+        return True
+
+def breaker_record(ok):
+    with breaker_lock:
+        if ok:
+            if breaker["state"] != "closed":
+                logger.info("🟢 Bot API снова отвечает, предохранитель замкнут")
+            breaker.update(state="closed", failures=0, probing=False)
+            return
+        breaker["failures"] += 1
+        if breaker["state"] == "half_open" or breaker["failures"] >= BREAKER_FAILURES:
+            if breaker["state"] != "open":
+                api_stats["opened"] += 1
+                logger.error(f"🔴 Bot API не отвечает ({breaker['failures']} ошибок подряд), предохранитель разомкнут на {BREAKER_COOLDOWN:.0f} сек")
+            breaker.update(state="open", opened_at=time.monotonic(), probing=False)
+
+def breaker_status():
+    with breaker_lock:
+        status = dict(api_stats, state=breaker["state"], consecutive_failures=breaker["failures"])
+        if breaker["state"] == "open":
+            status["retry_in_s"] = round(max(0.0, BREAKER_COOLDOWN - (time.monotonic() - breaker["opened_at"])), 1)
+    return status
+
+def call_api(method, data):
+    """Вызывает Bot API; None - вызова не было или сеть подвела.
+    Повторяет с джиттером только идемпотентные методы."""
+    attempts = 1 + (API_RETRIES if method in IDEMPOTENT_METHODS else 0)
+    response = None
+    for attempt in range(attempts):
+        if attempt:
+            count_api("retries")
+            time.sleep(max(0.0, min(random.uniform(0, API_RETRY_BASE * 2 ** attempt), budget_left())))
+        left = budget_left()
+        if left <= 0.05:
+            count_api("over_budget")
+            logger.warning(f"⏳ {method}: бюджет апдейта исчерпан")
+            return None
+        if not breaker_allow():
+            count_api("short_circuited")
+            return None
+        count_api("calls")
+        response = None
+        try:
+            response = api_session.post(
+                api_url(method), json=data,
+                timeout=(min(API_CONNECT_TIMEOUT, left), min(API_READ_TIMEOUT, left))
+            )
+        except requests.RequestException as e:
+            logger.warning(f"⚠️ {method}: {e}")
+        finally:
+            failed = response is None or response.status_code >= 500
+            breaker_record(not failed)
+        if not failed:
+            return response
+        count_api("failures")
+    return response
+
+# --- UI helpers ---
+
+@traced
+def send_message(chat_id, text, reply_markup=None, durable=True):
+    data = {"chat_id": chat_id, "text": text}
+    if reply_markup:
+        data["reply_markup"] = reply_markup
+    logger.info(f"📤 Отправляем сообщение в чат {chat_id}: {text[:50]}...")
+    return deliver("sendMessage", data, durable)
+
+@traced
+def edit_message(chat_id, message_id, text, reply_markup=None):
+    data = {"chat_id": chat_id, "message_id": message_id, "text": text}
+    if reply_markup:
+        data["reply_markup"] = reply_markup
+    return deliver("editMessageText", data)
+
+def deliver(method, data, durable=True):
+    """Вызывает Bot API; при временной ошибке кладет вызов в outbox.
+    durable=False - вызывающий сам разбирается с ошибками (рассылка)."""
+    chat_id = data["chat_id"]
+    if durable and (current_tenant()["name"], str(chat_id)) in outbox_chats:
+        # В чате уже есть недоставленное - встаем в очередь за ним, чтобы не нарушить порядок
+        enqueue_outbox(method, data)
+        return None
+    response = call_api(method, data)
+    if response is None:
+        # Сеть, открытый предохранитель или кончился бюджет апдейта
+        if durable:
+            enqueue_outbox(method, data)
+        return None
+    if not response.ok:
+        logger.error(f"❌ Ошибка {method}: {response.status_code} - {response.text}")
+        if durable and is_retryable(response.status_code):
+            enqueue_outbox(method, data, retry_after(response) if response.status_code == 429 else 1)
+    else:
+        logger.info(f"✅ {method} выполнен успешно")
+    return response
+
+def is_retryable(status_code):
+    return status_code == 429 or status_code >= 500
+
+def retry_after(response, default=1):
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery"
-        data = {"callback_query_id": callback_query_id}
-        if text:
-            data["text"] = text
-        requests.post(url, data=data, timeout=10)
+        return response.json().get("parameters", {}).get("retry_after", default)
     except Exception:
-        logger.exception("Ошибка answerCallbackQuery")
+        return default
+
+@traced
+def answer_callback_query(callback_query_id, text=None):
+    data = {"callback_query_id": callback_query_id}
+    if text:
+        data["text"] = text
+    call_api("answerCallbackQuery", data)
+
+def build_keyboard_rows(rows):
+    # rows: [[(text, payload), ...], ...]
+    return {"inline_keyboard": [[{"text": t, "callback_data": p} for t, p in row] for row in rows]}
 
 def get_message_hash(message):
-    s = str(message.get('message_id', '')) + str(message.get('date', ''))
+    s = current_tenant()["name"] + str(message.get('message_id', '')) + str(message.get('date', ''))
     return hashlib.md5(s.encode()).hexdigest()
 
 def build_inline_keyboard(options_with_payload):
@@ -258,79 +1019,73 @@ def detect_gender_correction(text):
     
     return None
 
-def bati_name_ask():
+# --- Persona templates ---
+# Тексты бати лежат в persona.json. При старте для каждого пола местоимения
+# подставляются заранее, а на вызове остается один str.format по готовой строке.
+PERSONA_GENDERS = ("male", "female", "unknown")
+
+class KeepMissing(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+def load_persona(path):
+    """Компилирует шаблоны: ключ -> пол -> кортеж вариантов"""
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    compiled = {}
+    for key, variants in raw.items():
+        compiled[key] = {
+            gender: tuple(v.format_map(KeepMissing(get_gender_pronoun(gender))) for v in variants)
+            for gender in PERSONA_GENDERS
+        }
+    return compiled
+
+def persona_seed(name):
+    # Детерминированно для пользователя и между рестартами, в отличие от hash()
+    return zlib.crc32(name.encode()) if name else 0
+
+def render(key, gender, seed=0, **fields):
+    by_gender = current_tenant()["persona"][key]
+    variants = by_gender.get(gender) or by_gender["unknown"]
+    return variants[seed % len(variants)].format(**fields)
+
+def bati_name_ask(seed=0):
     """Батю спрашивает имя"""
-    greetings = [
-        "Блять, кто это тут у меня? Назови свое имя, а то я не знаю, как к тебе обращаться! 😤",
-        "Слушай, детка, как тебя зовут? Я должен знать, с кем имею дело на кухне! 👨‍🍳",
-        "Ну что, незнакомец, представься! Как тебя родители назвали? 🤔",
-        "Блять, да кто ты такой? Имя скажи, а то я не буду с анонимом готовить! 😠"
-    ]
-    return greetings[0]
+    return render("name_ask", "unknown", seed)
 
 def bati_greeting(name, gender):
-    pronouns = get_gender_pronoun(gender)
-    greetings = [
-        f"А, {name}! Ну что, {pronouns['address']}, готов(а) к кулинарным подвигам? Я тебе сейчас такое блюдо покажу, что ебать! 🔥",
-        f"Так, {name}, {pronouns['address']} мой! Сегодня будем готовить по-настоящему, как в ресторане! 👨‍🍳",
-        f"Слушай, {name}, {pronouns['address']}, я тебе сейчас такое блюдо покажу, что пальчики оближешь! Ебать, какая вкуснятина будет! 😋",
-        f"Ну что, {name}, {pronouns['address']}, добро пожаловать в мою кухню! Сегодня будем творить кулинарные шедевры! 🍳"
-    ]
-    return greetings[0]
+    return render("greeting", gender, persona_seed(name), name=name)
 
 def bati_gender_correction(name, old_gender, new_gender):
     """Батю корректирует пол"""
-    old_pronouns = get_gender_pronoun(old_gender)
-    new_pronouns = get_gender_pronoun(new_gender)
-    
-    corrections = [
-        f"А, блять, {name}! Извини, {old_pronouns['address']}, я думал ты {old_pronouns['address']}, а ты {new_pronouns['address']}! Ну ладно, {new_pronouns['address']}, продолжаем! 😅",
-        f"Ебать, {name}, я ошибся! Ты же {new_pronouns['address']}, а не {old_pronouns['address']}! Ну ладно, {new_pronouns['address']}, давай готовить! 🤦‍♂️",
-        f"Слушай, {name}, я перепутал! Ты {new_pronouns['address']}, а я тебя {old_pronouns['address']} называл! Извини, {new_pronouns['address']}! 😅",
-        f"Блять, {name}, я облажался! Ты {new_pronouns['address']}, а не {old_pronouns['address']}! Ну ладно, {new_pronouns['address']}, поехали дальше! 🤷‍♂️"
-    ]
-    return corrections[0]
+    old_address = get_gender_pronoun(old_gender)['address']
+    return render("gender_correction", new_gender, persona_seed(name), name=name, old_address=old_address)
 
 def bati_ingredients_ask(name, gender):
-    pronouns = get_gender_pronoun(gender)
-    return f"Слушай, {name}, {pronouns['address']}, расскажи мне честно - что у тебя в холодильнике лежит? И в шкафчиках тоже посмотри! Напиши все продукты, какие есть, через запятую или просто списком. Я из этого добра что-то вкусное состряпаю! Ебать, какая вкуснятина получится! 🥘"
+    return render("ingredients_ask", gender, persona_seed(name), name=name)
 
 def bati_recipe_intro(name, gender, recipe_name):
-    pronouns = get_gender_pronoun(gender)
-    intros = [
-        f"Отлично, {name}, {pronouns['address']}! Я для тебя выбрал рецепт '{recipe_name}'. Это классика, проверенная временем! Ебать, какая вкуснятина будет! 👨‍🍳",
-        f"Слушай, {name}, {pronouns['address']}, '{recipe_name}' - это то, что нужно! Я сам так готовил еще в молодости! Блять, как же это вкусно! 🔥",
-        f"Ну что, {name}, {pronouns['address']}, готовим '{recipe_name}'? Это блюдо никогда не подводило! Ебать, пальчики оближешь! 😋"
-    ]
-    return intros[0]
+    return render("recipe_intro", gender, persona_seed(name), name=name, recipe_name=recipe_name)
 
 def bati_cooking_step(step_num, instruction, name, gender):
-    pronouns = get_gender_pronoun(gender)
-    step_intros = [
-        f"Шаг {step_num}, {name}, {pronouns['address']}:",
-        f"Слушай внимательно, {name}, {pronouns['address']}, шаг {step_num}:",
-        f"Теперь, {name}, {pronouns['address']}, делаем так - шаг {step_num}:",
-        f"Запоминай, {name}, {pronouns['address']}, шаг {step_num}:"
-    ]
-    return f"{step_intros[0]} {instruction}"
+    # Вступление меняется от шага к шагу
+    return render("cooking_step", gender, persona_seed(name) + step_num,
+                  name=name, step_num=step_num, instruction=instruction)
 
-def bati_encouragement(name, gender):
-    pronouns = get_gender_pronoun(gender)
-    encouragements = [
-        f"Молодец, {name}, {pronouns['address']}! У тебя получается! Ебать, какие у тебя руки золотые! 👍",
-        f"Так держать, {name}, {pronouns['address']}! Ты настоящий повар! Блять, как же ты быстро учишься! 👨‍🍳",
-        f"Отлично, {name}, {pronouns['address']}! Вижу, что руки растут откуда надо! Ебать, какой ты молодец! 🔥",
-        f"Красота, {name}, {pronouns['address']}! Учишься быстро! Блять, ты просто повар от бога! 😋"
-    ]
-    return encouragements[0]
+def bati_encouragement(name, gender, seed=0):
+    return render("encouragement", gender, persona_seed(name) + seed, name=name)
 
 def bati_no_ingredients(name, gender):
-    pronouns = get_gender_pronoun(gender)
-    return f"Блять, {name}, {pronouns['address']}, с такими продуктами особо не разгуляешься... Может, сходишь в магазин за мясом или овощами? Или закажешь доставку? А то из воздуха еду не сделаешь! 🛒"
+    return render("no_ingredients", gender, persona_seed(name), name=name)
 
 def bati_recipe_found(name, gender, count):
-    pronouns = get_gender_pronoun(gender)
-    return f"Ебать, {name}, {pronouns['address']}! Из твоих продуктов я могу приготовить {count} блюд! Смотри, что у меня получилось:"
+    return render("recipe_found", gender, persona_seed(name), name=name, count=count)
+
+SMALL_TALK = [
+    'спасибо', 'благодарю', 'отлично', 'круто', 'классно', 'супер',
+    'не работает', 'ошибка', 'проблема', 'не получается', 'сломалось',
+    'кто ты', 'что ты', 'как дела', 'как поживаешь',
+]
 
 def handle_any_message(chat_id, user_id, text, session):
     """Обрабатывает любые сообщения пользователя в зависимости от контекста"""
@@ -341,6 +1096,11 @@ def handle_any_message(chat_id, user_id, text, session):
     
     text_lower = text.lower().strip()
     
+    # Вопросы по рецептам ищем полнотекстом: "как жарить оладьи", "что с фаршем"
+    if not any(word in text_lower for word in SMALL_TALK):
+        if answer_recipe_question(chat_id, text, name, gender):
+            return True
+    
     # Обработка вопросов о готовке
     if any(word in text_lower for word in ['как готовить', 'как приготовить', 'что делать', 'помоги', 'объясни']):
         if stage == 'ask_ingredients':
@@ -383,101 +1143,149 @@ def handle_any_message(chat_id, user_id, text, session):
     return False
 
 # --- Recipe database ---
-RECIPES = {
-    "паста_карбонара": {
-        "name": "Паста Карбонара",
-        "ingredients": ["макароны", "бекон", "яйца", "сыр_пармезан", "чеснок", "соль", "перец"],
-        "optional": ["лук"],
-        "instructions": [
-            "Поставь большую кастрюлю с подсоленной водой на огонь",
-            "Пока вода закипает, нарежь бекон мелкими кубиками",
-            "Натри сыр на мелкой терке",
-            "Взбей яйца с сыром, добавь соль и перец",
-            "Обжарь бекон на сковороде до хрустящего состояния",
-            "Добавь измельченный чеснок к бекону",
-            "Отвари макароны до состояния аль денте",
-            "Слей воду, оставив немного для соуса",
-            "Смешай горячие макароны с беконом",
-            "Сними с огня и добавь яично-сырную смесь, быстро перемешивая",
-            "Подавай сразу, посыпав пармезаном"
-        ]
-    },
-    "борщ": {
-        "name": "Борщ",
-        "ingredients": ["говядина", "свекла", "капуста", "морковь", "лук", "картофель", "томаты", "чеснок", "соль", "перец", "лавровый_лист"],
-        "optional": ["укроп", "сметана"],
-        "instructions": [
-            "Свари мясной бульон из говядины",
-            "Натри свеклу на крупной терке",
-            "Нарежь капусту соломкой",
-            "Нарежь картофель кубиками",
-            "Нарежь лук и морковь",
-            "Обжарь лук и морковь на растительном масле",
-            "Добавь к ним свеклу и томаты, туши 10 минут",
-            "Добавь овощи в кипящий бульон",
-            "Вари 20 минут, добавь картофель",
-            "Вари еще 15 минут, добавь капусту",
-            "Добавь соль, перец, лавровый лист",
-            "Вари еще 10 минут, добавь чеснок",
-            "Подавай со сметаной и укропом"
-        ]
-    },
-    "плов": {
-        "name": "Плов",
-        "ingredients": ["рис", "мясо", "морковь", "лук", "чеснок", "соль", "перец", "куркума", "растительное_масло"],
-        "optional": ["барбарис", "зира"],
-        "instructions": [
-            "Промой рис до чистой воды",
-            "Нарежь мясо кубиками",
-            "Нарежь лук полукольцами, морковь соломкой",
-            "Разогрей масло в казане или толстостенной кастрюле",
-            "Обжарь мясо до золотистой корочки",
-            "Добавь лук, обжарь до прозрачности",
-            "Добавь морковь, обжарь 5 минут",
-            "Добавь специи и соль",
-            "Добавь рис, разровняй",
-            "Залей горячей водой на 2 см выше риса",
-            "Добавь целые зубчики чеснока",
-            "Вари на сильном огне до выпаривания воды",
-            "Уменьши огонь, накрой крышкой, томи 20 минут",
-            "Перемешай и подавай"
-        ]
-    },
-    "салат_цезарь": {
-        "name": "Салат Цезарь",
-        "ingredients": ["салат", "курица", "сыр_пармезан", "хлеб", "чеснок", "майонез", "горчица", "соль", "перец"],
-        "optional": ["анчоусы", "каперсы"],
-        "instructions": [
-            "Нарежь хлеб кубиками и обжарь с чесноком",
-            "Отвари курицу и нарежь кубиками",
-            "Порви салат руками",
-            "Смешай майонез с горчицей и чесноком",
-            "Добавь соль и перец в соус",
-            "Смешай салат с курицей",
-            "Заправь соусом",
-            "Посыпь пармезаном и сухариками",
-            "Подавай сразу"
-        ]
-    },
-    "оладьи": {
-        "name": "Оладьи",
-        "ingredients": ["мука", "молоко", "яйца", "сахар", "соль", "дрожжи", "растительное_масло"],
-        "optional": ["ванилин"],
-        "instructions": [
-            "Подогрей молоко до теплого состояния",
-            "Раствори дрожжи в молоке с сахаром",
-            "Добавь яйца и соль",
-            "Постепенно добавь муку, размешивая",
-            "Замеси тесто до консистенции сметаны",
-            "Накрой полотенцем, дай подойти 30 минут",
-            "Разогрей масло на сковороде",
-            "Выкладывай тесто ложкой",
-            "Жарь с двух сторон до золотистого цвета",
-            "Подавай со сметаной или вареньем"
-        ]
+def load_corpus(json_path=RECIPES_FILE, snapshot_path=RECIPES_SNAPSHOT):
+    """Берет скомпилированный снапшот, если он свежее JSON, иначе читает JSON"""
+    if snapshot_path and os.path.exists(snapshot_path):
+        if os.path.exists(json_path) and os.path.getmtime(json_path) > os.path.getmtime(snapshot_path):
+            logger.warning(f"⚠️ Снапшот {snapshot_path} старее {json_path}, читаем JSON")
+        else:
+            try:
+                recipes = RecipeSnapshot(snapshot_path)
+                logger.info(f"📦 Рецепты из снапшота {snapshot_path}: {len(recipes)}")
+                return recipes
+            except (OSError, ValueError):
+                logger.exception(f"💥 Не удалось открыть снапшот {snapshot_path}")
+    recipes = load_recipes_json(json_path)
+    logger.info(f"📖 Рецепты из {json_path}: {len(recipes)}")
+    return recipes
+
+# --- Tenants ---
+# Несколько ботов в одном процессе. У тенанта свой токен, путь вебхука
+# /webhook/<имя>, база рецептов, тексты и файл БД; пул соединений, воркеры,
+# писатель БД и кэши общие. Без TENANTS_FILE есть один тенант "default"
+# из BOT_TOKEN/RECIPES_FILE/PERSONA_FILE/DB_PATH на старом пути /webhook.
+DEFAULT_TENANT_NAME = "default"
+corpora = {}  # путь к JSON -> {"key", "recipes", "index"}, общие для тенантов с одной базой
+personas = {}  # путь -> скомпилированные шаблоны
+tenant_context = threading.local()
+
+def get_corpus(json_path, snapshot_path):
+    key = os.path.abspath(json_path)
+    if key not in corpora:
+        recipes = load_corpus(json_path, snapshot_path)
+        corpora[key] = {
+            "key": key,
+            "json_path": json_path,
+            "snapshot_path": snapshot_path,
+            "recipes": recipes,
+            "index": build_prefix_index(recipes),
+        }
+    return corpora[key]
+
+def get_persona(path):
+    key = os.path.abspath(path)
+    if key not in personas:
+        personas[key] = load_persona(path)
+    return personas[key]
+
+def make_tenant(name, token, recipes_file, snapshot_file, persona_file, db_path, webhook_path, admin_chat_id):
+    corpus = get_corpus(recipes_file, snapshot_file)
+    return {
+        "name": name,
+        "token": token,
+        "corpus": corpus["key"],
+        "recipes": corpus["recipes"],
+        "index": corpus["index"],
+        "persona": get_persona(persona_file),
+        "db_path": db_path,
+        "webhook_path": webhook_path,
+        "admin_chat_id": admin_chat_id,
     }
-}
 
+def load_tenants(path=TENANTS_FILE):
+    """Реестр тенантов: имя -> тенант. Пути в файле - относительно самого файла"""
+    if not path:
+        return {DEFAULT_TENANT_NAME: make_tenant(
+            DEFAULT_TENANT_NAME, BOT_TOKEN, RECIPES_FILE, RECIPES_SNAPSHOT, PERSONA_FILE,
+            DB_PATH, "/webhook", ADMIN_CHAT_ID
+        )}
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    db_root, db_ext = os.path.splitext(DB_PATH)
+    tenants = {}
+    for name, conf in config.items():
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+            raise ValueError(f"{path}: имя тенанта '{name}' должно быть из латиницы, цифр, _ и -")
+        resolve = lambda p: os.path.join(base_dir, p)
+        recipes_file = resolve(conf.get("recipes", RECIPES_FILE))
+        token = conf.get("token") or os.getenv(conf.get("token_env", ""))
+        if not token:
+            raise ValueError(f"{path}: у тенанта '{name}' нет токена (token или token_env)")
+        tenants[name] = make_tenant(
+            name,
+            token,
+            recipes_file,
+            resolve(conf["snapshot"]) if "snapshot" in conf else os.path.splitext(recipes_file)[0] + ".snap",
+            resolve(conf.get("persona", PERSONA_FILE)),
+            resolve(conf["db"]) if "db" in conf else f"{db_root}.{name}{db_ext or '.db'}",
+            f"/webhook/{name}",
+            conf.get("admin_chat_id", ADMIN_CHAT_ID),
+        )
+        logger.info(f"🏷️ Тенант {name}: {tenants[name]['db_path']}, рецептов {len(tenants[name]['recipes'])}")
+    return tenants
+
+TENANTS = load_tenants()
+DEFAULT_TENANT = TENANTS.get(DEFAULT_TENANT_NAME) or next(iter(TENANTS.values()))
+
+def current_tenant():
+    return getattr(tenant_context, "tenant", None) or DEFAULT_TENANT
+
+@contextmanager
+def use_tenant(tenant):
+    previous = getattr(tenant_context, "tenant", None)
+    tenant_context.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        tenant_context.tenant = previous
+
+def in_tenant(fn):
+    """Оборачивает fn для другого потока так, чтобы он работал в текущем тенанте"""
+    tenant = current_tenant()
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with use_tenant(tenant):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def for_each_tenant(fn):
+    for tenant in TENANTS.values():
+        with use_tenant(tenant):
+            fn()
+
+def tenant_key(user_id):
+    """Ключ для кэшей по пользователю: один человек может писать нескольким ботам"""
+    return current_tenant()["name"], user_id
+
+class CurrentRecipes(Mapping):
+    """Рецепты текущего тенанта; код ниже пишет RECIPES[recipe_id] как раньше"""
+
+    def __getitem__(self, recipe_id):
+        return current_tenant()["recipes"][recipe_id]
+
+    def __iter__(self):
+        return iter(current_tenant()["recipes"])
+
+    def __len__(self):
+        return len(current_tenant()["recipes"])
+
+    def __contains__(self, recipe_id):
+        return recipe_id in current_tenant()["recipes"]
+
+RECIPES = CurrentRecipes()
+
+@traced
 def parse_ingredients(text):
     """Парсит ингредиенты из свободного текста"""
     try:
@@ -512,30 +1320,49 @@ def parse_ingredients(text):
         logger.exception(f"💥 Ошибка парсинга ингредиентов: {e}")
         return []
 
+MATCH_THRESHOLD = 0.7  # доля обязательных ингредиентов, с которой рецепт показывается
+
+def recipe_match(recipe_id, recipe, available, score):
+    return {
+        'id': recipe_id,
+        'name': recipe['name'],
+        'missing_required': list(set(recipe['ingredients']) - available),
+        'missing_optional': list(set(recipe.get('optional', [])) - available),
+        'score': score
+    }
+
+@lru_cache(maxsize=None)
+def recipe_matrix(corpus):
+    """Матрица рецепт x ингредиент и соседи всех рецептов, строятся пачкой при первом обращении"""
+    started = time.monotonic()
+    matrix = RecipeMatrix(corpora[corpus]["recipes"], top_k=SIMILAR_TOP_K)
+    logger.info(f"🧮 Матрица {len(matrix.recipe_ids)}x{len(matrix.vocab)} построена за {time.monotonic() - started:.2f} сек")
+    return matrix
+
+@traced
 def find_matching_recipes(ingredients):
     """Находит рецепты по имеющимся ингредиентам"""
     matches = []
+    available = set(ingredients)
+    
+    if MATCH_ENGINE == "matrix":
+        # Все рецепты разом: матрица на вектор холодильника
+        matrix = recipe_matrix(current_tenant()["corpus"])
+        for recipe_id, score in matrix.match(available, MATCH_THRESHOLD):
+            matches.append(recipe_match(recipe_id, RECIPES[recipe_id], available, score))
+        matches.sort(key=lambda x: x['score'], reverse=True)
+        return matches
     
     for recipe_id, recipe in RECIPES.items():
         required = set(recipe['ingredients'])
-        optional = set(recipe.get('optional', []))
-        available = set(ingredients)
         
         # Проверяем, сколько обязательных ингредиентов есть
-        missing_required = required - available
-        has_required = len(required - missing_required)
+        has_required = len(required & available)
         required_ratio = has_required / len(required)
         
         # Если есть хотя бы 70% обязательных ингредиентов
-        if required_ratio >= 0.7:
-            missing_optional = optional - available
-            matches.append({
-                'id': recipe_id,
-                'name': recipe['name'],
-                'missing_required': list(missing_required),
-                'missing_optional': list(missing_optional),
-                'score': required_ratio
-            })
+        if required_ratio >= MATCH_THRESHOLD:
+            matches.append(recipe_match(recipe_id, recipe, available, required_ratio))
     
     # Сортируем по количеству имеющихся ингредиентов
     matches.sort(key=lambda x: x['score'], reverse=True)
@@ -554,79 +1381,689 @@ def get_recipe_instructions(recipe_id, name, gender):
     
     return instructions
 
-# --- Conversation flows ---
-def start_cooking_flow(chat_id, user_id, name, gender):
-    """Начинает кулинарный диалог"""
-    save_session(user_id, "ask_ingredients", {"name": name, "gender": gender})
-    greeting = bati_greeting(name, gender)
-    ingredients_ask = bati_ingredients_ask(name, gender)
-    
-    send_message(chat_id, greeting)
-    send_message(chat_id, ingredients_ask)
+# --- Inline search ---
+def build_inline_article(recipe_id, recipe):
+    steps = "\n".join(f"{i}. {step}" for i, step in enumerate(recipe['instructions'], 1))
+    text = f"👨‍🍳 {recipe['name']}\n\nИнгредиенты: {', '.join(recipe['ingredients'])}"
+    if recipe.get('optional'):
+        text += f"\nДополнительно: {', '.join(recipe['optional'])}"
+    text += f"\n\n{steps}"
+    return {
+        "type": "article",
+        "id": hashlib.md5(recipe_id.encode()).hexdigest(),
+        "title": recipe['name'],
+        "description": ", ".join(recipe['ingredients']),
+        "input_message_content": {"message_text": text},
+    }
 
-def handle_ingredients(chat_id, user_id, text, name, gender):
-    """Обрабатывает список ингредиентов"""
-    try:
-        logger.info(f"🔍 Обрабатываем ингредиенты от {name}: {text}")
-        ingredients = parse_ingredients(text)
-        logger.info(f"📋 Распознанные ингредиенты: {ingredients}")
-        
-        if not ingredients:
-            pronouns = get_gender_pronoun(gender)
-            send_message(chat_id, f"Слушай, {name}, {pronouns['address']}, я ничего не понял! Напиши нормально, что у тебя есть из продуктов! Блять, как же я тебя пойму? 😅")
-            return
-        
-        # Сохраняем ингредиенты
-        save_session(user_id, "show_recipes", {"ingredients": ingredients, "name": name, "gender": gender})
-        
-        # Ищем подходящие рецепты
-        matches = find_matching_recipes(ingredients)
-        logger.info(f"🍳 Найдено рецептов: {len(matches)}")
-        
-        if not matches:
-            send_message(chat_id, bati_no_ingredients(name, gender))
-            return
-        
-        # Показываем рецепты
-        send_message(chat_id, bati_recipe_found(name, gender, len(matches)))
-        
-        recipe_options = []
-        for i, match in enumerate(matches[:5]):  # Показываем максимум 5 рецептов
-            missing_text = ""
-            if match['missing_required']:
-                missing_text = f" (нужно докупить: {', '.join(match['missing_required'])})"
-            recipe_options.append((f"{match['name']}{missing_text}", f"recipe_{match['id']}"))
-        
-        keyboard = build_inline_keyboard(recipe_options)
-        send_message(chat_id, "Выбирай, что будем готовить:", reply_markup=keyboard)
-    except Exception as e:
-        logger.exception(f"💥 Ошибка обработки ингредиентов: {e}")
-        send_message(chat_id, "Блять, что-то пошло не так! Попробуй еще раз!")
+def lookup_prefix(prefix):
+    """recipe_id -> лучший приоритет для всех слов, начинающихся с prefix"""
+    index = current_tenant()["index"]
+    tokens, entries = index["tokens"], index["entries"]
+    found = {}
+    i = bisect.bisect_left(tokens, prefix)
+    while i < len(tokens) and tokens[i].startswith(prefix):
+        _, priority, recipe_id = entries[i]
+        found[recipe_id] = min(priority, found.get(recipe_id, priority))
+        i += 1
+    return found
 
-def handle_recipe_selection(chat_id, user_id, recipe_id, name, gender):
-    """Обрабатывает выбор рецепта"""
-    if recipe_id not in RECIPES:
+def search_recipes(query):
+    return search_corpus(current_tenant()["corpus"], query)
+
+@lru_cache(maxsize=1024)
+def search_corpus(corpus, query):
+    """Ищет рецепты по префиксам всех слов запроса, лучшие совпадения первыми.
+    corpus - ключ кэша: тенанты с одной базой делят результаты"""
+    words = index_tokens(query)
+    if not words:
+        return tuple(sorted(RECIPES, key=lambda rid: RECIPES[rid]['name']))
+    scores = None
+    for word in words:
+        found = lookup_prefix(word)
+        if scores is None:
+            scores = found
+        else:
+            scores = {rid: scores[rid] + p for rid, p in found.items() if rid in scores}
+        if not scores:
+            return ()
+    return tuple(sorted(scores, key=lambda rid: (scores[rid], RECIPES[rid]['name'])))
+
+def build_inline_answer(query, offset):
+    """Страница результатов для answerInlineQuery"""
+    recipe_ids = search_recipes(query.strip().lower())
+    start = int(offset) if offset and offset.isdigit() else 0
+    page = recipe_ids[start:start + INLINE_PAGE_SIZE]
+    next_offset = str(start + INLINE_PAGE_SIZE) if start + INLINE_PAGE_SIZE < len(recipe_ids) else ""
+    corpus = current_tenant()["corpus"]
+    return [inline_article(corpus, rid) for rid in page], next_offset
+
+@traced
+def answer_inline_query(inline_query_id, results, next_offset=""):
+    data = {
+        "inline_query_id": inline_query_id,
+        "results": results,
+        "cache_time": INLINE_CACHE_TIME,
+        "is_personal": False,
+        "next_offset": next_offset,
+    }
+    call_api("answerInlineQuery", data)
+
+@lru_cache(maxsize=4096)
+def inline_article(corpus, recipe_id):
+    return build_inline_article(recipe_id, corpora[corpus]["recipes"][recipe_id])
+
+# --- Full-text search ---
+# Рецепты лежат в FTS5-таблице в БД тенанта: строка на рецепт (название и ингредиенты)
+# и строка на каждый шаг (название и текст шага). Русский учитывается так:
+# unicode61 складывает регистр и ё, а слова запроса обрезаются до основы и ищутся
+# по префиксу: "жарить" -> жар* находит "Жарь" и "жарьте".
+# В recipe_fts_meta хранится хэш рецепта и его rowid, поэтому при перечитывании базы
+# переиндексируются только изменившиеся рецепты.
+SEARCH_STOPWORDS = {
+    'как', 'что', 'где', 'когда', 'сколько', 'зачем', 'почему', 'какой', 'какая', 'какие',
+    'с', 'со', 'в', 'во', 'на', 'и', 'или', 'а', 'но', 'по', 'до', 'из', 'для', 'за', 'от', 'к',
+    'мне', 'меня', 'я', 'ты', 'мы', 'это', 'ли', 'же', 'бы', 'не', 'можно', 'нужно', 'надо',
+    'приготовить', 'готовить', 'сделать', 'делать', 'рецепт', 'блюдо', 'батя', 'подскажи', 'расскажи',
+    'помоги', 'объясни', 'понимаю', 'знаю', 'нибудь', 'есть', 'хочу',
+}
+RU_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией', 'ать', 'ять', 'ить', 'еть',
+    'ешь', 'ете', 'ите', 'ает', 'яет', 'ует', 'ют', 'ут', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий',
+    'ой', 'ей', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ую', 'юю', 'ть',
+    'ь', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'й',
+], key=len, reverse=True)
+SEARCH_SYNC_CHUNK = 500  # рецептов на одну запись писателю
+
+def create_search_tables(cur):
+    cur.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS recipe_fts USING fts5(
+            recipe_id UNINDEXED,
+            step UNINDEXED,
+            name,
+            ingredients,
+            instruction,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3 4'
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recipe_fts_meta (
+            recipe_id TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            first_rowid INTEGER NOT NULL,
+            row_count INTEGER NOT NULL
+        )
+        """
+    )
+
+def stem_ru(word):
+    """Грубая основа русского слова: снимает возвратную частицу и одно окончание"""
+    word = word.lower().replace('ё', 'е')
+    for suffix in ('ся', 'сь'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            word = word[:-len(suffix)]
+            break
+    for ending in RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+def search_terms(text):
+    return [stem_ru(word) for word in index_tokens(text) if word not in SEARCH_STOPWORDS and len(word) > 1]
+
+def recipe_digest(recipe):
+    """Хэш только индексируемых полей. Без ключа optional в JSON и пустой optional
+    снапшота - одно и то же, иначе смена источника переиндексирует всю базу"""
+    indexed = {
+        "name": recipe['name'],
+        "ingredients": recipe['ingredients'],
+        "optional": recipe.get('optional', []),
+        "instructions": recipe['instructions'],
+    }
+    return hashlib.md5(json.dumps(indexed, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+def search_rows(recipe_id, recipe):
+    """Строки FTS для рецепта: заголовок (step = -1) и по строке на шаг"""
+    name = recipe['name']
+    ingredients = " ".join(recipe['ingredients'] + recipe.get('optional', [])).replace('_', ' ')
+    rows = [(recipe_id, -1, name, ingredients, "")]
+    rows += [(recipe_id, i, name, "", step) for i, step in enumerate(recipe['instructions'])]
+    return rows
+
+def write_search_remove(cur, recipe_ids):
+    for recipe_id in recipe_ids:
+        cur.execute("SELECT first_rowid, row_count FROM recipe_fts_meta WHERE recipe_id = ?", (recipe_id,))
+        row = cur.fetchone()
+        if row:
+            # Удаление по диапазону rowid не сканирует всю таблицу, в отличие от WHERE recipe_id
+            cur.execute(
+                "DELETE FROM recipe_fts WHERE rowid BETWEEN ? AND ?",
+                (row["first_rowid"], row["first_rowid"] + row["row_count"] - 1)
+            )
+            cur.execute("DELETE FROM recipe_fts_meta WHERE recipe_id = ?", (recipe_id,))
+
+def write_search_rows(cur, items):
+    """Переиндексирует рецепты: items - [(recipe_id, digest, строки FTS)]"""
+    write_search_remove(cur, [recipe_id for recipe_id, _, _ in items])
+    cur.execute("SELECT COALESCE(MAX(rowid), 0) FROM recipe_fts")
+    next_rowid = cur.fetchone()[0] + 1
+    for recipe_id, digest, rows in items:
+        cur.executemany(
+            "INSERT INTO recipe_fts (rowid, recipe_id, step, name, ingredients, instruction) VALUES (?, ?, ?, ?, ?, ?)",
+            [(next_rowid + i, *row) for i, row in enumerate(rows)]
+        )
+        cur.execute(
+            "INSERT INTO recipe_fts_meta (recipe_id, digest, first_rowid, row_count) VALUES (?, ?, ?, ?)",
+            (recipe_id, digest, next_rowid, len(rows))
+        )
+        next_rowid += len(rows)
+
+def sync_search_index():
+    """Приводит индекс текущего тенанта к базе рецептов, трогая только изменения"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT recipe_id, digest FROM recipe_fts_meta")
+        indexed = {row["recipe_id"]: row["digest"] for row in cur.fetchall()}
+        conn.close()
+    except sqlite3.OperationalError:
+        logger.warning("⚠️ Поисковый индекс недоступен")
+        return 0
+    recipes = current_tenant()["recipes"]
+    changed = []
+    for recipe_id in recipes:
+        recipe = recipes[recipe_id]
+        digest = recipe_digest(recipe)
+        if indexed.get(recipe_id) != digest:
+            changed.append((recipe_id, digest, search_rows(recipe_id, recipe)))
+    removed = [recipe_id for recipe_id in indexed if recipe_id not in recipes]
+    for i in range(0, len(changed), SEARCH_SYNC_CHUNK):
+        db_write(write_search_rows, changed[i:i + SEARCH_SYNC_CHUNK])
+    if removed:
+        db_write(write_search_remove, removed)
+    wait_for_writes()
+    if changed or removed:
+        logger.info(f"🔎 Поиск {current_tenant()['name']}: переиндексировано {len(changed)}, удалено {len(removed)}")
+    return len(changed) + len(removed)
+
+@traced
+def search_corpus_text(text, limit=SEARCH_RESULTS):
+    """Рецепты по свободному тексту: [{"id", "step", "snippet"}], лучшие первыми"""
+    terms = search_terms(text)
+    if not terms:
+        return []
+    quoted = [f'"{term}"*' for term in terms]
+    hits = []
+    # Сначала все слова сразу, если ничего - хотя бы одно
+    for query in (" ".join(quoted), " OR ".join(quoted)) if len(quoted) > 1 else (quoted[0],):
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT recipe_id, step,
+                       CASE WHEN step >= 0 THEN snippet(recipe_fts, 4, '«', '»', '…', 12)
+                            ELSE snippet(recipe_fts, 3, '«', '»', '…', 12) END AS snippet
+                FROM recipe_fts WHERE recipe_fts MATCH ?
+                ORDER BY bm25(recipe_fts, 0, 0, 10.0, 4.0, 1.0) LIMIT ?
+                """,
+                (query, limit * 10)
+            )
+            hits = [dict(row) for row in cur.fetchall()]
+            conn.close()
+        except sqlite3.OperationalError:
+            logger.exception("💥 Ошибка полнотекстового поиска")
+            return []
+        if hits:
+            break
+    results, seen = [], set()
+    for hit in hits:
+        if hit["recipe_id"] in seen or hit["recipe_id"] not in RECIPES:
+            continue
+        seen.add(hit["recipe_id"])
+        results.append({"id": hit["recipe_id"], "step": hit["step"], "snippet": hit["snippet"]})
+        if len(results) == limit:
+            break
+    return results
+
+def answer_recipe_question(chat_id, text, name, gender):
+    """Отвечает найденными рецептами и шагами; False, если ничего не нашлось"""
+    results = search_corpus_text(text)
+    if not results:
+        return False
+    pronouns = get_gender_pronoun(gender)
+    lines = [f"Смотри, {name}, {pronouns['address']}, вот что нашел:"]
+    for result in results:
+        recipe_name = RECIPES[result["id"]]['name']
+        where = f", шаг {result['step'] + 1}" if result["step"] >= 0 else ""
+        lines.append(f"\n👨‍🍳 {recipe_name}{where}: {result['snippet']}")
+    options = [(RECIPES[result["id"]]['name'], f"recipe_{result['id']}") for result in results]
+    send_message(chat_id, "\n".join(lines), reply_markup=build_inline_keyboard(options))
+    return True
+
+# --- Pantry ---
+# Холодильник пользователя лежит в БД и меняется командами "добавь ..." / "убери ...".
+# В памяти на пользователя держится число имеющихся обязательных ингредиентов
+# по каждому рецепту: изменение продукта пересчитывает только рецепты, где он есть.
+PANTRY_CACHE_SIZE = 10000
+PANTRY_ADD_RE = re.compile(r'^(?:добавь|добавить|докупил|докупила|купил|купила)\s+(.+)$', re.S)
+PANTRY_REMOVE_RE = re.compile(r'^(?:убери|убрать|удали|удалить|выкинь)\s+(.+)$', re.S)
+PANTRY_SHOW = ['холодильник', 'мой холодильник', 'что в холодильнике', 'из холодильника', 'что у меня есть']
+PANTRY_CLEAR = ['очисти холодильник', 'очистить холодильник']
+PLAN_RE = re.compile(r'^(?:/plan|план|меню|план обеда)(?:\s+на)?(?:\s+(\d+))?(?:\s+блюд\w*)?$')
+pantries = {}  # (тенант, user_id) -> {"items", "have": {recipe_id: сколько обязательных есть}, "ranked"}
+pantries_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def ingredient_index(corpus):
+    """ингредиент -> рецепты, где он обязательный, и число обязательных у рецепта"""
+    recipes_by_ingredient, required_counts = {}, {}
+    for recipe_id, recipe in corpora[corpus]["recipes"].items():
+        required = set(recipe['ingredients'])
+        required_counts[recipe_id] = len(required)
+        for ingredient in required:
+            recipes_by_ingredient.setdefault(ingredient, []).append(recipe_id)
+    return recipes_by_ingredient, required_counts
+
+def read_pantry(user_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT ingredient FROM pantry WHERE user_id=?", (str(user_id),))
+    items = [row["ingredient"] for row in cur.fetchall()]
+    conn.close()
+    return items
+
+def write_pantry(cur, user_id, added, removed):
+    now = datetime.utcnow().isoformat()
+    cur.executemany(
+        "INSERT OR IGNORE INTO pantry (user_id, ingredient, added_at) VALUES (?, ?, ?)",
+        [(str(user_id), ingredient, now) for ingredient in added]
+    )
+    cur.executemany(
+        "DELETE FROM pantry WHERE user_id=? AND ingredient=?",
+        [(str(user_id), ingredient) for ingredient in removed]
+    )
+
+def count_pantry_item(state, ingredient, delta):
+    """Пересчитывает только рецепты, где ингредиент обязательный"""
+    recipes_by_ingredient, _ = ingredient_index(current_tenant()["corpus"])
+    have = state["have"]
+    for recipe_id in recipes_by_ingredient.get(ingredient, ()):
+        count = have.get(recipe_id, 0) + delta
+        if count:
+            have[recipe_id] = count
+        else:
+            have.pop(recipe_id, None)
+
+def load_pantry(user_id):
+    """Состояние холодильника из кэша, при промахе - из БД"""
+    key = tenant_key(user_id)
+    with pantries_lock:
+        state = pantries.pop(key, None)
+        if state is not None:
+            pantries[key] = state
+            return state
+    items = read_pantry(user_id)
+    state = {"items": set(), "have": {}, "ranked": None}
+    for ingredient in items:
+        state["items"].add(ingredient)
+        count_pantry_item(state, ingredient, 1)
+    with pantries_lock:
+        state = pantries.setdefault(key, state)
+        if len(pantries) > PANTRY_CACHE_SIZE:
+            pantries.pop(next(iter(pantries)))
+    return state
+
+def pantry_items(user_id):
+    state = load_pantry(user_id)
+    with pantries_lock:
+        return sorted(state["items"])
+
+def update_pantry(user_id, add=(), remove=()):
+    """Меняет холодильник; возвращает реально добавленное и убранное"""
+    state = load_pantry(user_id)
+    with pantries_lock:
+        added = [i for i in dict.fromkeys(add) if i not in state["items"]]
+        removed = [i for i in dict.fromkeys(remove) if i in state["items"]]
+        for ingredient in added:
+            state["items"].add(ingredient)
+            count_pantry_item(state, ingredient, 1)
+        for ingredient in removed:
+            state["items"].discard(ingredient)
+            count_pantry_item(state, ingredient, -1)
+        if added or removed:
+            state["ranked"] = None
+    if added or removed:
+        db_write(write_pantry, user_id, added, removed)
+    return added, removed
+
+@traced
+def pantry_matches(user_id):
+    """То же, что find_matching_recipes по холодильнику, но без прохода по всей базе:
+    счетчики обновляются только у рецептов с измененным продуктом, при любом MATCH_ENGINE"""
+    state = load_pantry(user_id)
+    with pantries_lock:
+        if state["ranked"] is None:
+            _, required_counts = ingredient_index(current_tenant()["corpus"])
+            matches = []
+            for recipe_id, count in state["have"].items():
+                score = count / required_counts[recipe_id]
+                if score >= MATCH_THRESHOLD:
+                    matches.append(recipe_match(recipe_id, RECIPES[recipe_id], state["items"], score))
+            matches.sort(key=lambda x: x['score'], reverse=True)
+            state["ranked"] = matches
+        return state["ranked"]
+
+@lru_cache(maxsize=None)
+def meal_planner(corpus):
+    """Битовые маски ингредиентов всех рецептов базы для планировщика"""
+    return MealPlanner(corpora[corpus]["recipes"])
+
+@traced
+def plan_meal(user_id, dishes=PLAN_DISHES):
+    """Набор блюд из холодильника с самым коротким списком покупок"""
+    planner = meal_planner(current_tenant()["corpus"])
+    plan = planner.plan(pantry_items(user_id), dishes, PLAN_BUDGET_MS, PLAN_CANDIDATES)
+    if plan and not plan["complete"]:
+        logger.info(f"⏱️ План обеда не досчитан за {PLAN_BUDGET_MS} мс, берем лучший из {plan['nodes']} вариантов")
+    return plan
+
+def format_pantry(items):
+    return ", ".join(item.replace('_', ' ') for item in items)
+
+def handle_pantry_command(chat_id, user_id, text, session):
+    """Команды холодильника; возвращает True, если текст был командой"""
+    text_lower = text.lower().strip()
+    added_match = PANTRY_ADD_RE.match(text_lower)
+    removed_match = PANTRY_REMOVE_RE.match(text_lower)
+    if not (added_match or removed_match or text_lower in PANTRY_SHOW or text_lower in PANTRY_CLEAR):
+        return False
+
+    name = session['data'].get('name', 'детка')
+    gender = session['data'].get('gender', 'unknown')
+    pronouns = get_gender_pronoun(gender)
+
+    if text_lower in PANTRY_CLEAR:
+        update_pantry(user_id, remove=pantry_items(user_id))
+        send_message(chat_id, f"Все, {name}, {pronouns['address']}, холодильник пустой! Пиши 'добавь ...', когда закупишься! 🧊")
+        return True
+
+    if added_match or removed_match:
+        ingredients = parse_ingredients((added_match or removed_match).group(1))
+        if added_match:
+            changed, _ = update_pantry(user_id, add=ingredients)
+            verb = "Положил в холодильник"
+        else:
+            _, changed = update_pantry(user_id, remove=ingredients)
+            verb = "Выкинул из холодильника"
+        if not changed:
+            send_message(chat_id, f"Слушай, {name}, {pronouns['address']}, там ничего не поменялось! Холодильник: {format_pantry(pantry_items(user_id)) or 'пусто'} 🧊")
+            return True
+        send_message(chat_id, f"{verb}: {format_pantry(changed)}! 🧊")
+
+    items = pantry_items(user_id)
+    if text_lower in PANTRY_SHOW:
+        if not items:
+            send_message(chat_id, f"Холодильник пустой, {name}, {pronouns['address']}! Напиши 'добавь картошка, мясо, лук' 🧊")
+            return True
+        send_message(chat_id, f"🧊 В холодильнике: {format_pantry(items)}")
+
+    if session['stage'] in ('ask_ingredients', 'show_recipes'):
+        save_session(user_id, "show_recipes", {**session['data'], "ingredients": items})
+    show_matches(chat_id, pantry_matches(user_id), name, gender)
+    return True
+
+def handle_plan_command(chat_id, user_id, text, session):
+    """/plan [N]: что приготовить из холодильника сразу на N блюд"""
+    plan_match = PLAN_RE.match(text.lower().strip())
+    if not plan_match:
+        return False
+
+    name = session['data'].get('name', 'детка')
+    gender = session['data'].get('gender', 'unknown')
+    pronouns = get_gender_pronoun(gender)
+    dishes = min(int(plan_match.group(1) or PLAN_DISHES), PLAN_MAX_DISHES)
+
+    plan = plan_meal(user_id, dishes) if dishes > 0 else None
+    if not plan:
+        send_message(chat_id, f"Из того, что в холодильнике, {name}, {pronouns['address']}, обед не собрать! Напиши 'добавь картошка, мясо, лук' 🧊")
+        return True
+
+    lines = [f"Вот тебе обед из {len(plan['recipes'])} блюд, {name}, {pronouns['address']}:"]
+    lines += [f"👨‍🍳 {RECIPES[recipe_id]['name']}" for recipe_id in plan['recipes']]
+    lines.append(f"\n🧊 Из холодильника: {format_pantry(plan['used'])}")
+    if plan['shopping']:
+        lines.append(f"🛒 Докупить: {format_pantry(plan['shopping'])}")
+    else:
+        lines.append("🛒 Докупать ничего не надо! Ебать, какой холодильник!")
+    options = [(RECIPES[recipe_id]['name'], f"recipe_{recipe_id}") for recipe_id in plan['recipes']]
+    send_message(chat_id, "\n".join(lines), reply_markup=build_inline_keyboard(options))
+    return True
+
+# --- Conversation flows ---
+def start_cooking_flow(chat_id, user_id, name, gender):
+    """Начинает кулинарный диалог"""
+    save_session(user_id, "ask_ingredients", {"name": name, "gender": gender})
+    greeting = bati_greeting(name, gender)
+    ingredients_ask = bati_ingredients_ask(name, gender)
+    
+    send_message(chat_id, greeting)
+    send_message(chat_id, ingredients_ask + pantry_reminder(user_id))
+
+def pantry_reminder(user_id):
+    items = pantry_items(user_id)
+    if not items:
+        return ""
+    return f"\n\n🧊 Помню, у тебя уже есть: {format_pantry(items)}. Допиши, что еще купил(а), или скажи 'из холодильника'!"
+
+def handle_ingredients(chat_id, user_id, text, name, gender):
+    """Обрабатывает список ингредиентов"""
+    try:
+        logger.info(f"🔍 Обрабатываем ингредиенты от {name}: {text}")
+        ingredients = parse_ingredients(text)
+        logger.info(f"📋 Распознанные ингредиенты: {ingredients}")
+        
+        if not ingredients:
+            pronouns = get_gender_pronoun(gender)
+            send_message(chat_id, f"Слушай, {name}, {pronouns['address']}, я ничего не понял! Напиши нормально, что у тебя есть из продуктов! Блять, как же я тебя пойму? 😅")
+            return
+        
+        # Кладем в холодильник, к тому, что там уже было
+        update_pantry(user_id, add=ingredients)
+        save_session(user_id, "show_recipes", {"ingredients": pantry_items(user_id), "name": name, "gender": gender})
+        
+        # Ищем подходящие рецепты
+        show_matches(chat_id, pantry_matches(user_id), name, gender)
+    except Exception as e:
+        logger.exception(f"💥 Ошибка обработки ингредиентов: {e}")
+        send_message(chat_id, "Блять, что-то пошло не так! Попробуй еще раз!")
+
+def show_matches(chat_id, matches, name, gender):
+    """Показывает найденные рецепты кнопками"""
+    logger.info(f"🍳 Найдено рецептов: {len(matches)}")
+    
+    if not matches:
+        send_message(chat_id, bati_no_ingredients(name, gender))
+        return
+    
+    # Показываем рецепты
+    send_message(chat_id, bati_recipe_found(name, gender, len(matches)))
+    
+    recipe_options = []
+    for i, match in enumerate(matches[:5]):  # Показываем максимум 5 рецептов
+        missing_text = ""
+        if match['missing_required']:
+            missing_text = f" (нужно докупить: {', '.join(match['missing_required'])})"
+        recipe_options.append((f"{match['name']}{missing_text}", f"recipe_{match['id']}"))
+    
+    keyboard = build_inline_keyboard(recipe_options)
+    send_message(chat_id, "Выбирай, что будем готовить:", reply_markup=keyboard)
+
+# --- Step navigation ---
+# Шаги листаются кнопками, callback_data несет рецепт и номер шага:
+# "step:<ключ рецепта>:<шаг>:<пол>". Одно сообщение правится через editMessageText,
+# а сессия пишется только при выборе рецепта и в конце готовки.
+GENDER_CODES = {"male": "m", "female": "f", "unknown": "u"}
+GENDERS_BY_CODE = {v: k for k, v in GENDER_CODES.items()}
+COOKS_CACHE_SIZE = 10000
+cooks = {}  # (тенант, user_id) -> {"name", "recipe_id", "step"}, без похода в БД на каждом шаге
+cooks_lock = threading.Lock()
+
+def recipe_key(recipe_id):
+    # callback_data ограничен 64 байтами, кириллический id может не влезть
+    return hashlib.md5(recipe_id.encode()).hexdigest()[:10]
+
+@lru_cache(maxsize=None)
+def recipe_keys(corpus):
+    """ключ -> recipe_id, строится при первом нажатии кнопки шага"""
+    return {recipe_key(rid): rid for rid in corpora[corpus]["recipes"]}
+
+def remember_cook(user_id, name, recipe_id, step):
+    key = tenant_key(user_id)
+    with cooks_lock:
+        cooks.pop(key, None)
+        cooks[key] = {"name": name, "recipe_id": recipe_id, "step": step}
+        if len(cooks) > COOKS_CACHE_SIZE:
+            cooks.pop(next(iter(cooks)))
+
+def recall_cook(user_id):
+    with cooks_lock:
+        return cooks.get(tenant_key(user_id))
+
+def forget_cook(user_id):
+    with cooks_lock:
+        cooks.pop(tenant_key(user_id), None)
+
+def cooking_recipe(user_id, recipe_id):
+    """Готовит ли пользователь сейчас этот рецепт; кнопки старых сообщений его не трогают"""
+    cook = recall_cook(user_id)
+    if cook:
+        return cook["recipe_id"] == recipe_id
+    session = get_session(user_id)
+    return bool(session) and session['stage'] == 'cooking' and session['data'].get('recipe_id') == recipe_id
+
+def step_keyboard(recipe_id, step, gender):
+    key = recipe_key(recipe_id)
+    g = GENDER_CODES.get(gender, "u")
+    row = []
+    if step > 0:
+        row.append(("⬅️ Назад", f"step:{key}:{step - 1}:{g}"))
+    if step + 1 < len(RECIPES[recipe_id]['instructions']):
+        row.append(("Далее ➡️", f"step:{key}:{step + 1}:{g}"))
+    else:
+        row.append(("✅ Готово", f"done:{key}:{g}"))
+    return build_keyboard_rows([row])
+
+def similar_keyboard(recipe_id):
+    return build_keyboard_rows([[("🍲 Похожие блюда", f"similar:{recipe_key(recipe_id)}")]])
+
+def handle_similar_callback(chat_id, action):
+    """Показывает блюда, похожие на рецепт из кнопки"""
+    recipe_id = recipe_keys(current_tenant()["corpus"]).get(action.split(":", 1)[1])
+    if recipe_id is None:
+        send_message(chat_id, "Блять, что-то пошло не так... Попробуй еще раз!")
+        return
+    similar = recipe_matrix(current_tenant()["corpus"]).similar(recipe_id)
+    if not similar:
+        send_message(chat_id, f"На {RECIPES[recipe_id]['name']} больше ничего не похоже, это уникальное блюдо! 😎")
+        return
+    options = [(RECIPES[rid]['name'], f"recipe_{rid}") for rid, _ in similar]
+    send_message(chat_id, f"Если нравится {RECIPES[recipe_id]['name']}, попробуй еще:", reply_markup=build_inline_keyboard(options))
+
+def parse_step_callback(action):
+    """'step:key:3:f' -> (recipe_id, 3, 'female'); None, если данные битые"""
+    parts = action.split(":")
+    try:
+        if parts[0] == "step" and len(parts) == 4:
+            return recipe_keys(current_tenant()["corpus"])[parts[1]], int(parts[2]), GENDERS_BY_CODE[parts[3]]
+        if parts[0] == "done" and len(parts) == 3:
+            return recipe_keys(current_tenant()["corpus"])[parts[1]], None, GENDERS_BY_CODE[parts[2]]
+    except (KeyError, ValueError):
+        pass
+    return None
+
+def cook_name(user_id):
+    """Имя из кэша; в БД идем, только если процесс перезапускался"""
+    cook = recall_cook(user_id)
+    if cook:
+        return cook["name"]
+    session = get_session(user_id)
+    return session['data'].get('name', 'детка') if session else 'детка'
+
+def handle_step_callback(chat_id, user_id, message_id, action, callback_id=None):
+    """Листает шаги в одном сообщении"""
+    parsed = parse_step_callback(action)
+    if parsed and not cooking_recipe(user_id, parsed[0]):
+        # Кнопка из прошлой готовки: после /start или другого рецепта сессию не трогаем
+        if callback_id:
+            answer_callback_query(callback_id, "Этот рецепт уже не активен. Напиши /start")
+        return
+    if callback_id:
+        answer_callback_query(callback_id)
+    if not parsed:
+        send_message(chat_id, "Блять, что-то пошло не так... Попробуй еще раз!")
+        return
+    recipe_id, step, gender = parsed
+    name = cook_name(user_id)
+    instructions = RECIPES[recipe_id]['instructions']
+
+    if step is None:
+        pronouns = get_gender_pronoun(gender)
+        edit_message(
+            chat_id, message_id,
+            f"Отлично, {name}, {pronouns['address']}! Блюдо готово! Ебать, как же это вкусно! Приятного аппетита! 🍽️",
+            reply_markup=similar_keyboard(recipe_id)
+        )
+        send_message(chat_id, "Хочешь приготовить что-то еще? Напиши /start")
+        save_session(user_id, "done", {"recipe_id": recipe_id, "name": name, "gender": gender, "step": len(instructions) - 1})
+        cancel_timer(chat_id)
+        return
+
+    if not 0 <= step < len(instructions):
+        return
+    remember_cook(user_id, name, recipe_id, step)
+    edit_message(
+        chat_id, message_id,
+        bati_cooking_step(step + 1, instructions[step], name, gender)
+        + timer_note(set_step_timer(chat_id, user_id, recipe_id, step, name, gender)),
+        reply_markup=step_keyboard(recipe_id, step, gender)
+    )
+
+def handle_recipe_selection(chat_id, user_id, recipe_id, name, gender):
+    """Обрабатывает выбор рецепта"""
+    if recipe_id not in RECIPES:
         send_message(chat_id, "Блять, что-то пошло не так... Попробуй еще раз!")
         return
     
     recipe = RECIPES[recipe_id]
     save_session(user_id, "cooking", {"recipe_id": recipe_id, "name": name, "gender": gender, "step": 0})
+    cancel_timer(chat_id)  # таймер прошлого рецепта больше не нужен
+    increment_counter(f"recipe:{recipe_id}")
+    remember_cook(user_id, name, recipe_id, 0)
     
+    # Вступление, ингредиенты и старт одним сообщением
     intro = bati_recipe_intro(name, gender, recipe['name'])
-    send_message(chat_id, intro)
-    
-    # Показываем ингредиенты
     ingredients_text = f"Ингредиенты:\n• {', '.join(recipe['ingredients'])}"
     if recipe.get('optional'):
         ingredients_text += f"\n• Дополнительно: {', '.join(recipe['optional'])}"
+    send_message(
+        chat_id,
+        f"{intro}\n\n{ingredients_text}\n\nНу что, начинаем готовить! Ебать, какая вкуснятина будет! 🔥",
+        reply_markup=similar_keyboard(recipe_id)
+    )
     
-    send_message(chat_id, ingredients_text)
-    
-    # Начинаем готовку
+    # Первый шаг с кнопками, дальше это сообщение правится на месте
     instructions = get_recipe_instructions(recipe_id, name, gender)
     if instructions:
-        send_message(chat_id, "Ну что, начинаем готовить! Ебать, какая вкуснятина будет! 🔥")
-        send_message(chat_id, instructions[0])
+        send_message(
+            chat_id,
+            instructions[0] + timer_note(set_step_timer(chat_id, user_id, recipe_id, 0, name, gender)),
+            reply_markup=step_keyboard(recipe_id, 0, gender)
+        )
 
 def handle_cooking_step(chat_id, user_id, name, gender):
     """Обрабатывает следующий шаг готовки"""
@@ -636,26 +2073,670 @@ def handle_cooking_step(chat_id, user_id, name, gender):
     
     recipe_id = session['data']['recipe_id']
     current_step = session['data'].get('step', 0)
+    # Если листали кнопками, актуальный шаг только в кэше
+    cook = recall_cook(user_id)
+    if cook and cook["recipe_id"] == recipe_id:
+        current_step = max(current_step, cook["step"])
     
     instructions = get_recipe_instructions(recipe_id, name, gender)
     
     if current_step + 1 < len(instructions):
         next_step = current_step + 1
-        save_session(user_id, "cooking", {**session['data'], "step": next_step})
+        last = next_step == len(instructions) - 1
+        # Последний шаг завершает готовку, как кнопка "Готово"
+        save_session(user_id, "done" if last else "cooking", {**session['data'], "step": next_step})
+        if not last:
+            remember_cook(user_id, name, recipe_id, next_step)
         
-        send_message(chat_id, instructions[next_step])
+        if last:
+            # Готовка уже завершена - напоминание о шаге пришло бы после "Приятного аппетита"
+            cancel_timer(chat_id)
+            send_message(chat_id, instructions[next_step])
+        else:
+            send_message(chat_id, instructions[next_step] + timer_note(set_step_timer(chat_id, user_id, recipe_id, next_step, name, gender)))
         
-        if next_step == len(instructions) - 1:
-            # Последний шаг
+        if last:
             pronouns = get_gender_pronoun(gender)
             send_message(chat_id, f"Готово, {name}, {pronouns['address']}! Ебать, какая вкуснятина получилась! Приятного аппетита! 🍽️")
             send_message(chat_id, "Хочешь приготовить что-то еще? Напиши /start")
     else:
         # Готовка завершена
+        save_session(user_id, "done", {**session['data'], "step": len(instructions) - 1})
+        cancel_timer(chat_id)
         pronouns = get_gender_pronoun(gender)
         send_message(chat_id, f"Отлично, {name}, {pronouns['address']}! Блюдо готово! Ебать, как же это вкусно! Приятного аппетита! 🍽️")
         send_message(chat_id, "Хочешь приготовить что-то еще? Напиши /start")
 
+# --- Cooking timers ---
+# Шаг со временем ("дай подойти 30 минут") заводит таймер, пока он на экране:
+# переход на другой шаг заменяет таймер чата, конец готовки отменяет его.
+# Все таймеры лежат в одной куче по времени срабатывания, ее разбирает один
+# поток-планировщик; отмененные записи остаются в куче и пропускаются при выемке.
+# Сработавшие таймеры отправляют несколько потоков через обычный send_message
+# со следующим шагом и кнопками. Таймеры пишутся в БД тенанта и после рестарта
+# поднимаются из нее, просроченные за время простоя срабатывают сразу.
+TIMER_RE = re.compile(r'(\d+(?:[.,]\d+)?)(?:\s*[-–]\s*(\d+(?:[.,]\d+)?))?\s*(час(?:а|ов)?|ч|мин\w*|сек\w*)\b')
+TIMER_UNITS = {"ч": 3600, "м": 60, "с": 1}  # по первой букве единицы
+timers = {}  # (тенант, chat_id) -> таймер
+timers_heap = []  # (due_at, seq, ключ, таймер)
+timers_cond = threading.Condition()
+timer_seq = itertools.count()
+timer_due = queue.Queue()
+timer_threads = []
+
+@lru_cache(maxsize=4096)
+def step_duration(text):
+    """Секунды из текста шага: 'дай подойти 30 минут' -> 1800, '5-7 минут' -> 420; None без времени"""
+    text = text.lower()
+    seconds = 1800 if 'полчаса' in text else 0
+    for match in TIMER_RE.finditer(text):
+        value = float((match.group(2) or match.group(1)).replace(',', '.'))
+        seconds += value * TIMER_UNITS[match.group(3)[0]]
+    return min(int(seconds), TIMER_MAX_SECONDS) or None
+
+def format_duration(seconds):
+    hours, minutes = divmod(round(seconds / 60), 60)
+    if hours and minutes:
+        return f"{hours} ч {minutes} мин"
+    if hours:
+        return f"{hours} ч"
+    return f"{max(minutes, 1)} мин"
+
+def timer_note(seconds):
+    return f"\n\n⏲️ Засек {format_duration(seconds)}, напомню!" if seconds else ""
+
+def set_step_timer(chat_id, user_id, recipe_id, step, name, gender):
+    """Заводит таймер шага, если в нем есть время, иначе снимает старый; возвращает секунды"""
+    seconds = step_duration(RECIPES[recipe_id]['instructions'][step])
+    if seconds:
+        schedule_timer(chat_id, user_id, recipe_id, step, name, gender, seconds)
+    else:
+        cancel_timer(chat_id)
+    return seconds
+
+def schedule_timer(chat_id, user_id, recipe_id, step, name, gender, seconds, due_at=None, persist=True):
+    timer = {
+        "tenant": current_tenant()["name"],
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "recipe_id": recipe_id,
+        "step": step,
+        "seconds": seconds,
+        "due_at": due_at or time.time() + seconds,
+        "name": name,
+        "gender": gender,
+    }
+    key = (timer["tenant"], str(chat_id))
+    ensure_timer_threads()
+    with timers_cond:
+        timers[key] = timer
+        heapq.heappush(timers_heap, (timer["due_at"], next(timer_seq), key, timer))
+        if len(timers_heap) > 2 * len(timers) + 1000:
+            # Слишком много отмененных записей - пересобираем кучу из живых
+            timers_heap[:] = [entry for entry in timers_heap if timers.get(entry[2]) is entry[3]]
+            heapq.heapify(timers_heap)
+        timers_cond.notify()
+    if persist:
+        db_write(write_timer, timer)
+    return timer
+
+def cancel_timer(chat_id):
+    with timers_cond:
+        timer = timers.pop((current_tenant()["name"], str(chat_id)), None)
+    if timer:
+        db_write(delete_timer, timer)
+
+def write_timer(cur, timer):
+    cur.execute(
+        "INSERT OR REPLACE INTO timers (chat_id, user_id, recipe_id, step, seconds, due_at, name, gender) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (str(timer["chat_id"]), str(timer["user_id"]), timer["recipe_id"], timer["step"], timer["seconds"],
+         timer["due_at"], timer["name"], timer["gender"])
+    )
+
+def delete_timer(cur, timer):
+    # Только свой таймер: если чат уже завел новый, его строка остается
+    cur.execute("DELETE FROM timers WHERE chat_id = ? AND due_at = ?", (str(timer["chat_id"]), timer["due_at"]))
+
+def ensure_timer_threads():
+    if timer_threads and all(thread.is_alive() for thread in timer_threads):
+        return
+    with timers_cond:
+        if timer_threads and all(thread.is_alive() for thread in timer_threads):
+            return
+        timer_threads[:] = [threading.Thread(target=timer_loop, name="timers", daemon=True)]
+        timer_threads.extend(
+            threading.Thread(target=timer_sender, name=f"timer-sender-{i}", daemon=True)
+            for i in range(TIMER_SENDERS)
+        )
+        for thread in timer_threads:
+            thread.start()
+
+def timer_loop():
+    """Единственный поток-планировщик: спит до ближайшего таймера и отдает его отправителям"""
+    while True:
+        with timers_cond:
+            while True:
+                # Отмененные и замененные таймеры пропускаем
+                while timers_heap and timers.get(timers_heap[0][2]) is not timers_heap[0][3]:
+                    heapq.heappop(timers_heap)
+                now = time.time()
+                if timers_heap and timers_heap[0][0] <= now:
+                    _, _, key, timer = heapq.heappop(timers_heap)
+                    del timers[key]
+                    break
+                timers_cond.wait(timers_heap[0][0] - now if timers_heap else None)
+        timer_due.put(timer)
+
+def timer_sender():
+    while True:
+        timer = timer_due.get()
+        tenant = TENANTS.get(timer["tenant"])
+        try:
+            if tenant is not None:
+                with use_tenant(tenant):
+                    fire_timer(timer)
+        except Exception:
+            logger.exception(f"💥 Ошибка напоминания в чат {timer['chat_id']}")
+        finally:
+            timer_due.task_done()
+
+def fire_timer(timer):
+    """Напоминает, что время шага вышло, и сразу показывает следующий шаг"""
+    chat_id, user_id, recipe_id = timer["chat_id"], timer["user_id"], timer["recipe_id"]
+    name, gender, step = timer["name"], timer["gender"], timer["step"]
+    pronouns = get_gender_pronoun(gender)
+    text = f"⏲️ {name}, {pronouns['address']}, {format_duration(timer['seconds'])} прошло!"
+    instructions = RECIPES[recipe_id]['instructions'] if recipe_id in RECIPES else []
+    if step + 1 < len(instructions):
+        remember_cook(user_id, name, recipe_id, step + 1)
+        seconds = set_step_timer(chat_id, user_id, recipe_id, step + 1, name, gender)
+        text += f" Дальше:\n\n{bati_cooking_step(step + 2, instructions[step + 1], name, gender)}{timer_note(seconds)}"
+        send_message(chat_id, text, reply_markup=step_keyboard(recipe_id, step + 1, gender))
+    elif instructions:
+        send_message(chat_id, f"{text} Жми «Готово»!", reply_markup=step_keyboard(recipe_id, len(instructions) - 1, gender))
+    else:
+        send_message(chat_id, text)
+    db_write(delete_timer, timer)
+    logger.info(f"⏲️ Напоминание в чат {chat_id}: {recipe_id}, шаг {step + 1}")
+
+def resume_timers():
+    """Поднимает таймеры тенанта из БД после рестарта"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM timers")
+    rows = [dict(row) for row in cur.fetchall()]
+    conn.close()
+    for row in rows:
+        user_id = int(row["user_id"]) if row["user_id"].lstrip("-").isdigit() else row["user_id"]
+        schedule_timer(
+            row["chat_id"], user_id, row["recipe_id"], row["step"], row["name"], row["gender"],
+            row["seconds"], due_at=row["due_at"], persist=False
+        )
+    if rows:
+        logger.info(f"⏲️ Восстановлено таймеров: {len(rows)}")
+
+# --- Broadcast ---
+BROADCAST_PAGE_SIZE = 200
+BROADCAST_LOG_EVERY = 25  # чекпоинт пишется после каждого пользователя, прогресс в лог - реже
+BROADCAST_RETRIES = 5  # повторов на пользователя при сетевой ошибке или 5xx
+BROADCAST_RETRY_BASE = 1.0  # сек, пауза удваивается с каждым повтором
+broadcast_lock = threading.Lock()
+broadcast_threads = {}  # тенант -> поток рассылки
+
+def iter_broadcast_users(after_user_id):
+    """Отдает user_id страницами по ключу, не загружая всю таблицу"""
+    while True:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT user_id FROM users WHERE blocked = 0 AND user_id > ? ORDER BY user_id LIMIT ?",
+            (after_user_id, BROADCAST_PAGE_SIZE)
+        )
+        page = [row["user_id"] for row in cur.fetchall()]
+        conn.close()
+        if not page:
+            return
+        yield from page
+        after_user_id = page[-1]
+
+def save_broadcast_progress(job):
+    return db_write(write_broadcast_progress, dict(job))
+
+def write_broadcast_progress(cur, job):
+    cur.execute(
+        "UPDATE broadcasts SET status=?, last_user_id=?, sent=?, failed=?, blocked=?, updated_at=? WHERE id=?",
+        (job["status"], job["last_user_id"], job["sent"], job["failed"], job["blocked"],
+         datetime.utcnow().isoformat(), job["id"])
+    )
+
+def mark_user_blocked(user_id):
+    return db_write(write_user_blocked, user_id)
+
+def write_user_blocked(cur, user_id):
+    cur.execute("UPDATE users SET blocked = 1, updated_at = ? WHERE user_id = ?", (datetime.utcnow().isoformat(), str(user_id)))
+
+def get_broadcast(broadcast_id=None):
+    conn = get_db()
+    cur = conn.cursor()
+    if broadcast_id is None:
+        cur.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+    else:
+        cur.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+    row = cur.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def broadcast_progress(job, elapsed):
+    """Скорость и ETA рассылки"""
+    done = job["sent"] + job["failed"] + job["blocked"] - job.get("done_at_start", 0)
+    rate = done / elapsed if elapsed > 0 else 0.0
+    remaining = max(job["total"] - job["sent"] - job["failed"] - job["blocked"], 0)
+    eta = remaining / rate if rate > 0 else None
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "total": job["total"],
+        "sent": job["sent"],
+        "failed": job["failed"],
+        "blocked": job["blocked"],
+        "rate_per_sec": round(rate, 2),
+        "eta_sec": round(eta) if eta is not None else None,
+    }
+
+def format_broadcast_progress(progress):
+    eta = f"{progress['eta_sec']} сек" if progress["eta_sec"] is not None else "—"
+    return (
+        f"📣 Рассылка #{progress['id']} ({progress['status']}): "
+        f"{progress['sent']}/{progress['total']} отправлено, "
+        f"{progress['blocked']} заблокировали, {progress['failed']} ошибок, "
+        f"{progress['rate_per_sec']} сообщ/сек, ETA {eta}"
+    )
+
+def run_broadcast(broadcast_id, report_chat_id=None):
+    """Рассылает сообщение всем пользователям с лимитом скорости и чекпоинтами"""
+    job = get_broadcast(broadcast_id)
+    if not job or job["status"] != "running":
+        return
+    job["done_at_start"] = job["sent"] + job["failed"] + job["blocked"]
+    logger.info(f"📣 Рассылка #{broadcast_id} стартует после пользователя '{job['last_user_id']}'")
+
+    interval = 1.0 / BROADCAST_RATE
+    started = time.monotonic()
+    next_send = started
+    try:
+        for user_id in iter_broadcast_users(job["last_user_id"]):
+            attempts = 0
+            while True:
+                while breaker_open():
+                    time.sleep(1)
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send = max(next_send + interval, time.monotonic())
+                response = send_message(user_id, job["text"], durable=False)
+                if response is not None and response.status_code == 429:
+                    wait = retry_after(response)
+                    logger.warning(f"🐢 Telegram просит подождать {wait} сек")
+                    time.sleep(wait)
+                    next_send = time.monotonic()
+                    continue
+                if (response is None or is_retryable(response.status_code)) and attempts < BROADCAST_RETRIES:
+                    # Сеть, бюджет или занятый пробный вызов предохранителя - временно, пробуем еще
+                    time.sleep(BROADCAST_RETRY_BASE * 2 ** attempts)
+                    attempts += 1
+                    next_send = time.monotonic()
+                    continue
+                break
+
+            if response is not None and response.ok:
+                job["sent"] += 1
+            elif response is not None and response.status_code == 403:
+                job["blocked"] += 1
+                mark_user_blocked(user_id)
+            else:
+                job["failed"] += 1
+            job["last_user_id"] = user_id
+
+            # Чекпоинт после каждой отправки: групповой коммит писателя делает это дешевым,
+            # а после падения повторно получит сообщение максимум один пользователь
+            save_broadcast_progress(job)
+            if (job["sent"] + job["failed"] + job["blocked"]) % BROADCAST_LOG_EVERY == 0:
+                logger.info(format_broadcast_progress(broadcast_progress(job, time.monotonic() - started)))
+        job["status"] = "done"
+    except Exception:
+        logger.exception(f"💥 Рассылка #{broadcast_id} прервана")
+        job["status"] = "failed"
+    save_broadcast_progress(job).result()
+
+    progress = broadcast_progress(job, time.monotonic() - started)
+    logger.info(format_broadcast_progress(progress))
+    if report_chat_id:
+        send_message(report_chat_id, format_broadcast_progress(progress))
+
+def broadcast_running():
+    thread = broadcast_threads.get(current_tenant()["name"])
+    return thread is not None and thread.is_alive()
+
+def launch_broadcast(broadcast_id, report_chat_id=None):
+    thread = threading.Thread(
+        target=in_tenant(run_broadcast), args=(broadcast_id, report_chat_id), daemon=True
+    )
+    broadcast_threads[current_tenant()["name"]] = thread
+    thread.start()
+
+def create_broadcast(text, report_chat_id=None):
+    """Создает рассылку и запускает ее в фоне; None, если уже идет другая"""
+    with broadcast_lock:
+        if broadcast_running():
+            return None
+        broadcast_id = db_write(write_new_broadcast, text).result()
+        launch_broadcast(broadcast_id, report_chat_id)
+        return broadcast_id
+
+def write_new_broadcast(cur, text):
+    now = datetime.utcnow().isoformat()
+    cur.execute("SELECT COUNT(*) FROM users WHERE blocked = 0")
+    total = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO broadcasts (text, status, total, started_at, updated_at) VALUES (?, 'running', ?, ?, ?)",
+        (text, total, now, now)
+    )
+    return cur.lastrowid
+
+def resume_broadcasts():
+    """Продолжает рассылку, прерванную рестартом"""
+    job = get_broadcast()
+    if job and job["status"] == "running":
+        logger.info(f"🔁 Продолжаем рассылку #{job['id']}")
+        with broadcast_lock:
+            launch_broadcast(job["id"], current_tenant()["admin_chat_id"])
+
+def current_broadcast_progress():
+    job = get_broadcast()
+    if not job:
+        return None
+    # Скорость оцениваем по времени с момента запуска
+    elapsed = (datetime.utcnow() - datetime.fromisoformat(job["started_at"])).total_seconds()
+    return broadcast_progress(job, elapsed)
+
+# --- Inbox ---
+# Апдейт сохраняется в inbox до ответа Telegram, обрабатывается воркером
+# и помечается done. Незавершенные апдейты переигрываются при старте.
+# Апдейты одного чата всегда попадают в одну очередь, поэтому идут по порядку.
+# Внутри очереди воркера тенанты обслуживаются по кругу.
+update_queues = []
+update_workers_lock = threading.Lock()
+
+class FairQueue:
+    """Очередь воркера с подочередью на тенанта: шумный бот не задерживает остальных"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = {}  # тенант -> deque; порядок ключей - порядок обхода
+        self._unfinished = 0
+
+    def put(self, tenant_name, item):
+        with self._cond:
+            self._queues.setdefault(tenant_name, deque()).append(item)
+            self._unfinished += 1
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            while not self._queues:
+                self._cond.wait()
+            tenant_name = next(iter(self._queues))
+            items = self._queues.pop(tenant_name)
+            item = items.popleft()
+            if items:
+                self._queues[tenant_name] = items  # в конец круга
+            return item
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(items) for items in self._queues.values())
+
+def write_inbox(cur, update_id, payload):
+    cur.execute(
+        "INSERT OR IGNORE INTO inbox (update_id, payload, status, received_at) VALUES (?, ?, 'pending', ?)",
+        (update_id, payload, datetime.utcnow().isoformat())
+    )
+    return cur.rowcount == 1
+
+def write_inbox_done(cur, update_id):
+    cur.execute("UPDATE inbox SET status = 'done' WHERE update_id = ?", (update_id,))
+
+def store_update(data):
+    """Сохраняет апдейт; False, если Telegram прислал его повторно"""
+    update_id = data.get("update_id")
+    if update_id is None:
+        return True
+    return db_write(write_inbox, update_id, json.dumps(data, ensure_ascii=False)).result()
+
+def ensure_update_workers():
+    if update_queues:
+        return
+    with update_workers_lock:
+        if update_queues:
+            return
+        for i in range(UPDATE_WORKERS):
+            q = FairQueue()
+            threading.Thread(target=update_worker, args=(q,), name=f"update-worker-{i}", daemon=True).start()
+            update_queues.append(q)
+
+def dispatch_update(data, profile=False, reply=None):
+    ensure_update_workers()
+    user_id, chat_id, _ = update_identity(data)
+    tenant = current_tenant()
+    shard = zlib.crc32(f"{tenant['name']}:{chat_id or user_id}".encode()) % len(update_queues)
+    update_queues[shard].put(tenant["name"], (tenant, data, time.monotonic(), profile, reply))
+
+def dispatch_reply(data, method, payload):
+    """Ответ на апдейт без его обработки: вызов Bot API в воркере чата, по порядку с остальными"""
+    dispatch_update(data, reply=(method, payload))
+
+def send_reply(method, payload):
+    with api_budget(UPDATE_BUDGET_MS):
+        if "chat_id" in payload:
+            deliver(method, payload)
+        else:
+            call_api(method, payload)
+
+def update_worker(q):
+    while True:
+        tenant, data, enqueued, profile, reply = q.get()
+        record_queue_latency(time.monotonic() - enqueued)
+        try:
+            with use_tenant(tenant):
+                if reply:
+                    send_reply(*reply)
+                else:
+                    process_update(data, profile)
+        except Exception:
+            logger.exception("💥 Ошибка воркера апдейтов")
+        finally:
+            q.task_done()
+
+def process_update(data, profile=False):
+    update_id = data.get("update_id")
+    tracing = trace_request("process_update", update_id=update_id, tenant=current_tenant()["name"]) if TRACE_FILE else nullcontext()
+    profiling = profile_request(update_id) if profile else nullcontext()
+    with tracing, profiling:
+        try:
+            with api_budget(UPDATE_BUDGET_MS):
+                handle_update(data)
+        finally:
+            if update_id is not None and "inline_query" not in data:
+                db_write(write_inbox_done, update_id)
+            with span("wait_for_writes"):
+                wait_for_writes()
+
+def drain_updates():
+    """Ждет, пока воркеры разберут все апдейты в очередях"""
+    for q in list(update_queues):
+        q.join()
+
+def replay_inbox():
+    """Переигрывает апдейты, не обработанные до рестарта, и чистит старые"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT payload FROM inbox WHERE status = 'pending' ORDER BY update_id")
+    pending = [json.loads(row["payload"]) for row in cur.fetchall()]
+    conn.close()
+    db_write(prune_inbox)
+    if pending:
+        logger.info(f"🔁 Переигрываем {len(pending)} необработанных апдейтов")
+    for data in pending:
+        if drop_stale(data):
+            # После долгого простоя на старые сообщения не отвечаем, как и на вебхуке
+            db_write(write_inbox_done, data.get("update_id"))
+            continue
+        dispatch_update(data)
+
+def prune_inbox(cur):
+    cutoff = datetime.utcfromtimestamp(time.time() - 86400).isoformat()
+    cur.execute("DELETE FROM inbox WHERE status = 'done' AND received_at < ?", (cutoff,))
+
+# --- Outbox ---
+outbox_chats = set()  # (тенант, чат) с недоставленными вызовами
+outbox_chats_lock = threading.Lock()
+outbox_wakeup = threading.Event()
+outbox_lock = threading.Lock()
+outbox_thread = None
+OUTBOX_BATCH = 50
+
+def write_outbox(cur, chat_id, method, payload, next_attempt_at):
+    cur.execute(
+        "INSERT INTO outbox (chat_id, method, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+        (str(chat_id), method, payload, next_attempt_at, datetime.utcnow().isoformat())
+    )
+
+def enqueue_outbox(method, data, delay=1):
+    chat_id = str(data["chat_id"])
+    with outbox_chats_lock:
+        db_write(write_outbox, chat_id, method, json.dumps(data, ensure_ascii=False), time.time() + delay).result()
+        outbox_chats.add((current_tenant()["name"], chat_id))
+    logger.warning(f"📮 {method} для чата {chat_id} отложен в outbox")
+    ensure_outbox_worker()
+
+def write_outbox_delete(cur, row_id):
+    cur.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+def write_outbox_retry(cur, row_id, attempts, next_attempt_at):
+    cur.execute("UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?", (attempts, next_attempt_at, row_id))
+
+def ensure_outbox_worker():
+    global outbox_thread
+    with outbox_lock:
+        if outbox_thread is None or not outbox_thread.is_alive():
+            outbox_thread = threading.Thread(target=outbox_worker, name="outbox", daemon=True)
+            outbox_thread.start()
+    outbox_wakeup.set()
+
+def outbox_worker():
+    while True:
+        outbox_wakeup.wait(1)
+        outbox_wakeup.clear()
+        for tenant in TENANTS.values():
+            try:
+                with use_tenant(tenant):
+                    drain_outbox()
+            except Exception:
+                logger.exception(f"💥 Ошибка разбора outbox тенанта {tenant['name']}")
+
+def drain_outbox():
+    """Отправляет то, что пора, для текущего тенанта; по чату строго по порядку,
+    пока не упрется в ошибку"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM outbox ORDER BY id LIMIT ?", (OUTBOX_BATCH,))
+    rows = [dict(row) for row in cur.fetchall()]
+    conn.close()
+
+    blocked_chats = set()
+    for row in rows:
+        chat_id = row["chat_id"]
+        if chat_id in blocked_chats or row["next_attempt_at"] > time.time():
+            blocked_chats.add(chat_id)
+            continue
+        if breaker_open():
+            break  # Telegram недоступен: ждем, пока предохранитель остынет
+        response = call_api(row["method"], json.loads(row["payload"]))
+        status = response.status_code if response is not None else None
+        if response is None and breaker_open():
+            break  # попытку не засчитываем
+
+        if response is not None and response.ok:
+            db_write(write_outbox_delete, row["id"])
+        elif (status is None or is_retryable(status)) and row["attempts"] + 1 < OUTBOX_MAX_ATTEMPTS:
+            delay = retry_after(response) if status == 429 else min(2 ** row["attempts"], 300)
+            db_write(write_outbox_retry, row["id"], row["attempts"] + 1, time.time() + delay)
+            blocked_chats.add(chat_id)
+        else:
+            logger.error(f"❌ Outbox: {row['method']} для чата {chat_id} отброшен (статус {status})")
+            db_write(write_outbox_delete, row["id"])
+    wait_for_writes()
+
+    # Чаты без оставшихся записей снова отправляют напрямую
+    with outbox_chats_lock:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT chat_id FROM outbox")
+        remaining = {row["chat_id"] for row in cur.fetchall()}
+        conn.close()
+        name = current_tenant()["name"]
+        outbox_chats.difference_update(
+            [(tenant, chat) for tenant, chat in outbox_chats if tenant == name and chat not in remaining]
+        )
+    if len(rows) == OUTBOX_BATCH and not blocked_chats:
+        outbox_wakeup.set()
+
+def resume_outbox():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT chat_id FROM outbox")
+    chats = {(current_tenant()["name"], row["chat_id"]) for row in cur.fetchall()}
+    conn.close()
+    if chats:
+        with outbox_chats_lock:
+            outbox_chats.update(chats)
+        logger.info(f"📮 В outbox есть недоставленное для {len(chats)} чатов")
+        ensure_outbox_worker()
+
+# --- Corpus reload ---
+def warm_up():
+    """Фоновая подготовка тенанта: матрица рецептов, соседи, планировщик и поисковый индекс"""
+    recipe_matrix(current_tenant()["corpus"])
+    meal_planner(current_tenant()["corpus"])
+    sync_search_index()
+
+def reload_corpora():
+    """Перечитывает базы рецептов всех тенантов без рестарта; возвращает число рецептов по тенантам"""
+    for key, corpus in list(corpora.items()):
+        recipes = load_corpus(corpus["json_path"], corpus["snapshot_path"])
+        corpora[key] = dict(corpus, recipes=recipes, index=build_prefix_index(recipes))
+    for tenant in TENANTS.values():
+        corpus = corpora[tenant["corpus"]]
+        tenant.update(recipes=corpus["recipes"], index=corpus["index"])
+    # Кэши посчитаны по старой базе
+    for cached in (search_corpus, inline_article, recipe_keys, ingredient_index, recipe_matrix, meal_planner):
+        cached.cache_clear()
+    with pantries_lock:
+        pantries.clear()
+    for_each_tenant(warm_up)
+    return {name: len(tenant["recipes"]) for name, tenant in TENANTS.items()}
+
 # --- Health check ---
 @app.route("/", methods=["GET"])
 def health_check():
@@ -663,16 +2744,134 @@ def health_check():
 
 @app.route("/health", methods=["GET"])
 def health():
-    return {"status": "ok", "bot": "cooking-mentor"}, 200
+    with admission_lock:
+        admission = dict(admission_stats, queue_latency_ms=round(queue_latency_ewma, 1))
+    queues = {
+        "updates_pending": sum(q.qsize() for q in update_queues),
+        "outbox_chats": len(outbox_chats),
+    }
+    telegram_api = breaker_status()
+    status = "ok" if telegram_api["state"] == "closed" else "degraded"
+    return {
+        "status": status,
+        "bot": "cooking-mentor",
+        "tenants": list(TENANTS),
+        "admission": admission,
+        "queues": queues,
+        "telegram_api": telegram_api,
+    }, 200
+
+def request_tenant():
+    """Тенант админского запроса: ?tenant=имя, по умолчанию - основной"""
+    name = request.args.get("tenant")
+    return TENANTS.get(name) if name else DEFAULT_TENANT
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    if not is_admin_request():
+        return {"error": "forbidden"}, 403
+    tenant = request_tenant()
+    if tenant is None:
+        return {"error": "unknown tenant"}, 404
+    with use_tenant(tenant):
+        return get_stats(), 200
+
+@app.route("/broadcast", methods=["GET", "POST"])
+def broadcast():
+    if not is_admin_request():
+        return {"error": "forbidden"}, 403
+    tenant = request_tenant()
+    if tenant is None:
+        return {"error": "unknown tenant"}, 404
+    with use_tenant(tenant):
+        return broadcast_for_tenant()
+
+@app.route("/reload", methods=["POST"])
+def reload():
+    if not is_admin_request():
+        return {"error": "forbidden"}, 403
+    recipes = reload_corpora()
+    logger.info(f"🔄 Базы рецептов перечитаны: {recipes}")
+    return {"recipes": recipes}, 200
+
+@app.route("/export/<table>", methods=["GET"])
+def export(table):
+    """Потоковая выгрузка таблицы: ?format=ndjson|csv&since=<водяной знак>&gzip=1"""
+    if not is_admin_request():
+        return {"error": "forbidden"}, 403
+    tenant = request_tenant()
+    if tenant is None:
+        return {"error": "unknown tenant"}, 404
+    if table not in EXPORT_TABLES:
+        return {"error": "unknown table", "tables": list(EXPORT_TABLES)}, 404
+    fmt = request.args.get("format", "ndjson")
+    compress = request.args.get("gzip") in ("1", "true")
+    try:
+        stream = export_stream(tenant["db_path"], table, fmt, request.args.get("since"), compress)
+        # Первая порция здесь, чтобы ошибка запроса стала 400, а не оборванным ответом
+        first = next(stream, b"")
+    except (ValueError, sqlite3.Error) as e:
+        return {"error": str(e)}, 400
+    logger.info(f"📦 Выгрузка {table} ({fmt}{', gzip' if compress else ''}) тенанта {tenant['name']}")
+    return Response(
+        itertools.chain([first], stream),
+        mimetype="application/gzip" if compress else FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={export_filename(table, fmt, compress)}"},
+    )
+
+def broadcast_for_tenant():
+    if request.method == "POST":
+        text = (request.get_json(silent=True) or {}).get("text", "").strip()
+        if not text:
+            return {"error": "text is required"}, 400
+        if len(text) > BROADCAST_MAX_TEXT:
+            return {"error": f"text is longer than {BROADCAST_MAX_TEXT} characters"}, 400
+        broadcast_id = create_broadcast(text)
+        if broadcast_id is None:
+            return {"error": "broadcast already running"}, 409
+    progress = current_broadcast_progress()
+    return progress or {}, 200
 
 # --- Webhook ---
 @app.route("/webhook", methods=["POST"])
-def telegram_webhook():
+@app.route("/webhook/<tenant_name>", methods=["POST"])
+def telegram_webhook(tenant_name=None):
+    tenant = TENANTS.get(tenant_name or DEFAULT_TENANT_NAME)
+    if tenant is None:
+        return {"error": "unknown tenant"}, 404
+    with use_tenant(tenant):
+        return accept_update()
+
+def accept_update():
+    data = request.get_json(silent=True)
+    logger.info(f"📨 Получен webhook: {data}")
+    if not data:
+        logger.info("❌ Пустой webhook")
+        return "OK", 200
+
+    if not admit_update(data):
+        return "OK", 200
+
+    if "inline_query" in data:
+        # Inline-запрос живет секунды: ждать коммита в inbox незачем, а переигрывать
+        # после рестарта бессмысленно - Telegram уже не примет ответ
+        dispatch_update(data, should_profile())
+        return "OK", 200
+
+    if not store_update(data):
+        logger.info("🔄 Апдейт уже в inbox, пропускаем")
+        return "OK", 200
+    dispatch_update(data, should_profile())
+    return "OK", 200
+
+@traced
+def handle_update(data):
+    """Обрабатывает один апдейт Telegram"""
     try:
-        data = request.get_json()
-        logger.info(f"📨 Получен webhook: {data}")
-        if not data:
-            logger.info("❌ Пустой webhook")
+        if "inline_query" in data:
+            query = data["inline_query"]
+            results, next_offset = build_inline_answer(query.get("query", ""), query.get("offset", ""))
+            answer_inline_query(query["id"], results, next_offset)
             return "OK", 200
 
         if "callback_query" in data:
@@ -683,11 +2882,14 @@ def telegram_webhook():
             user = cb.get("from", {})
             user_id = user.get("id")
 
-            if callback_id and callback_id in processed_callback_ids:
+            callback_key = (current_tenant()["name"], callback_id)
+            if callback_id and callback_key in processed_callback_ids:
                 return "OK", 200
+            step_action = bool(action) and action.startswith(("step:", "done:"))
             if callback_id:
-                processed_callback_ids.add(callback_id)
-                answer_callback_query(callback_id)
+                processed_callback_ids.add(callback_key)
+                if not step_action:
+                    answer_callback_query(callback_id)  # кнопки шагов отвечают сами, иногда с текстом
 
             if action and action.startswith("recipe_"):
                 recipe_id = action.replace("recipe_", "")
@@ -698,6 +2900,15 @@ def telegram_webhook():
                     handle_recipe_selection(chat_id, user_id, recipe_id, name, gender)
                 return "OK", 200
 
+            if action and action.startswith("similar:"):
+                handle_similar_callback(chat_id, action)
+                return "OK", 200
+
+            if step_action:
+                message_id = cb.get("message", {}).get("message_id")
+                handle_step_callback(chat_id, user_id, message_id, action, callback_id)
+                return "OK", 200
+
             if action == "next_step":
                 session = get_session(user_id)
                 if session:
@@ -730,13 +2941,40 @@ def telegram_webhook():
 
         if "text" in msg:
             text = msg["text"].strip()
+            if not (text.startswith("/broadcast") and is_admin_chat(chat_id)):
+                # Текст рассылки от админа не обрезаем до MAX_TEXT_LENGTH, у него свой лимит
+                text = clip_text(text)
             logger.info(f"📝 Текстовое сообщение: '{text}'")
             
             if text == "/start":
                 logger.info("🚀 Обработка команды /start")
-                # Сбрасываем сессию
+                # Сбрасываем сессию вместе с таймером прошлого рецепта
                 save_session(user_id, "ask_name", {})
-                send_message(chat_id, bati_name_ask())
+                cancel_timer(chat_id)
+                send_message(chat_id, bati_name_ask(user_id or 0))
+                return "OK", 200
+
+            if text == "/stats" and is_admin_chat(chat_id):
+                send_message(chat_id, format_stats(get_stats()))
+                return "OK", 200
+
+            if text.startswith("/broadcast") and is_admin_chat(chat_id):
+                if text == "/broadcast_status":
+                    progress = current_broadcast_progress()
+                    send_message(chat_id, format_broadcast_progress(progress) if progress else "Рассылок еще не было")
+                    return "OK", 200
+                broadcast_text = text[len("/broadcast"):].strip()
+                if not broadcast_text:
+                    send_message(chat_id, "Напиши так: /broadcast текст сообщения")
+                    return "OK", 200
+                clipped = len(broadcast_text) > BROADCAST_MAX_TEXT
+                broadcast_text = broadcast_text[:BROADCAST_MAX_TEXT]
+                broadcast_id = create_broadcast(broadcast_text, chat_id)
+                if broadcast_id is None:
+                    send_message(chat_id, "Блять, рассылка уже идет! Смотри /broadcast_status")
+                else:
+                    note = f" (текст обрезан до {BROADCAST_MAX_TEXT} символов - лимит Telegram)" if clipped else ""
+                    send_message(chat_id, f"📣 Рассылка #{broadcast_id} запущена{note}")
                 return "OK", 200
 
             # Обработка имени
@@ -752,6 +2990,7 @@ def telegram_webhook():
                 gender = detect_gender_by_name(name)
                 if gender == "unknown":
                     gender = "male"  # По умолчанию
+                    increment_counter("gender_fallback")
                 
                 # Сохраняем пользователя
                 upsert_user(user_id, user.get("username"), gender)
@@ -762,7 +3001,7 @@ def telegram_webhook():
                 ingredients_ask = bati_ingredients_ask(name, gender)
                 
                 send_message(chat_id, greeting)
-                send_message(chat_id, ingredients_ask)
+                send_message(chat_id, ingredients_ask + pantry_reminder(user_id))
                 return "OK", 200
 
             # Проверка на поправку пола
@@ -782,6 +3021,13 @@ def telegram_webhook():
                         send_message(chat_id, correction_msg)
                         return "OK", 200
 
+            # Холодильник: "добавь ...", "убери ...", "холодильник"
+            if session and session['data'].get('name'):
+                if handle_pantry_command(chat_id, user_id, text, session):
+                    return "OK", 200
+                if handle_plan_command(chat_id, user_id, text, session):
+                    return "OK", 200
+
             # Обработка ингредиентов
             if session and session['stage'] == 'ask_ingredients':
                 name = session['data'].get('name', 'детка')
@@ -830,31 +3076,36 @@ def telegram_webhook():
         return "OK", 200
 
 def set_webhook():
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook"
-        webhook_url = WEBHOOK_URL.rstrip("/") + "/webhook"
-        resp = requests.post(url, json={"url": webhook_url}, timeout=10)
-        if resp.ok:
-            logger.info(f"✅ Webhook установлен: {webhook_url}")
-        else:
-            logger.error(f"❌ Ошибка webhook: {resp.status_code} - {resp.text}")
-    except Exception:
-        logger.exception("Ошибка установки webhook")
+    webhook_url = WEBHOOK_URL.rstrip("/") + current_tenant()["webhook_path"]
+    resp = call_api("setWebhook", {"url": webhook_url})
+    if resp is not None and resp.ok:
+        logger.info(f"✅ Webhook установлен: {webhook_url}")
+    elif resp is not None:
+        logger.error(f"❌ Ошибка webhook: {resp.status_code} - {resp.text}")
+    else:
+        logger.error(f"❌ Bot API недоступен, webhook {webhook_url} не установлен")
 
 if __name__ == "__main__":
     logger.info("🚀 Запуск кулинарного бота-бати...")
     
     # Initialize database
     try:
-        init_db()
+        for_each_tenant(init_db)
         logger.info("✅ База данных инициализирована")
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
         sys.exit(1)
     
+    for_each_tenant(resume_outbox)
+    for_each_tenant(replay_inbox)
+    for_each_tenant(resume_broadcasts)
+    for_each_tenant(resume_timers)
+    # Матрицы рецептов, соседи и поисковый индекс строятся в фоне, чтобы не задерживать старт
+    threading.Thread(target=for_each_tenant, args=(warm_up,), daemon=True).start()
+
     # Set webhook
     try:
-        set_webhook()
+        for_each_tenant(set_webhook)
     except Exception as e:
         logger.error(f"❌ Ошибка установки webhook: {e}")
         # Don't exit, continue without webhook for testing
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Планировщик обеда из нескольких блюд по холодильнику.
+
+find_matching_recipes оценивает рецепты поодиночке, а здесь ищется набор из
+N блюд, для которого общий список покупок минимален, а продуктов из
+холодильника уходит как можно больше.
+
+Ингредиенты интернируются в ID, и набор ингредиентов рецепта - битовая маска
+(int): блюда объединяются через OR, список покупок - это обязательные
+ингредиенты AND NOT холодильник, а его размер - bit_count.
+
+Перебор - ветви и границы по кандидатам, отсортированным по числу
+недостающих. Жадный план дает первую оценку. Ветка отсекается, когда ее
+покупки уже больше лучших (объединение масок только растет), а при равных
+покупках - когда даже все оставшиеся кандидаты не добавят продуктов из
+холодильника. Как только кончается бюджет времени, возвращается лучший
+найденный план.
+
+    python meal_planner.py recipes.json "макароны, яйца, бекон, лук" 3
+"""
+
+import sys
+import time
+
+from recipe_snapshot import interned_ingredients
+
+CHECK_EVERY = 1024  # узлов перебора между проверками бюджета
+
+
+class MealPlanner:
+    def __init__(self, recipes):
+        self.names, ingredient_ids = interned_ingredients(recipes)
+        self.recipe_ids = list(ingredient_ids)
+        self.vocab = {name: i for i, name in enumerate(self.names)}
+        self.required = []    # маска обязательных ингредиентов
+        self.everything = []  # маска обязательных и дополнительных
+        for rid in self.recipe_ids:
+            required_ids, optional_ids = ingredient_ids[rid]
+            required = self._bits(required_ids)
+            self.required.append(required)
+            self.everything.append(required | self._bits(optional_ids))
+
+    @staticmethod
+    def _bits(ids):
+        mask = 0
+        for i in ids:
+            mask |= 1 << i
+        return mask
+
+    def mask(self, ingredients):
+        """Маска продуктов по названиям; незнакомые базе пропускаются"""
+        return self._bits(self.vocab[i] for i in ingredients if i in self.vocab)
+
+    def ingredients(self, mask):
+        """Названия ингредиентов маски в порядке ID"""
+        names = []
+        while mask:
+            low = mask & -mask
+            names.append(self.names[low.bit_length() - 1])
+            mask ^= low
+        return names
+
+    def plan(self, pantry, dishes=3, budget_ms=300, max_candidates=300):
+        """Лучший набор блюд: {"recipes", "shopping", "used", "complete", "nodes"}
+        или None, если ни один рецепт не использует холодильник"""
+        have = self.mask(pantry)
+        # Кандидаты - рецепты, которым пригодится хоть что-то из холодильника
+        candidates = []
+        for row in range(len(self.recipe_ids)):
+            use = self.everything[row] & have
+            if use:
+                missing = self.required[row] & ~have
+                candidates.append((missing.bit_count(), -use.bit_count(), row, missing, use))
+        candidates.sort(key=lambda c: c[:3])
+        candidates = candidates[:max_candidates]
+        dishes = min(dishes, len(candidates))
+        if not dishes:
+            return None
+
+        count = len(candidates)
+        missing_counts = [c[0] for c in candidates]
+        missing = [c[3] for c in candidates]
+        use = [c[4] for c in candidates]
+        # suffix_use[i] - все продукты холодильника, которые еще могут дать кандидаты i..
+        suffix_use = [0] * (count + 1)
+        for i in reversed(range(count)):
+            suffix_use[i] = suffix_use[i + 1] | use[i]
+
+        best = self._greedy(missing, use, dishes)
+        deadline = time.perf_counter() + budget_ms / 1000
+        state = {"nodes": 0, "complete": True}
+
+        def search(start, left, picked, shop, used):
+            for j in range(start, count - left + 1):
+                state["nodes"] += 1
+                if state["nodes"] % CHECK_EVERY == 0 and time.perf_counter() > deadline:
+                    state["complete"] = False
+                if not state["complete"]:
+                    return
+                if missing_counts[j] > best["shopping"]:
+                    break  # дальше кандидаты только хуже
+                shop_j = shop | missing[j]
+                shopping = shop_j.bit_count()
+                if shopping > best["shopping"]:
+                    continue
+                used_j = used | use[j]
+                if left == 1:
+                    if (shopping, -used_j.bit_count()) < (best["shopping"], -best["used"]):
+                        best.update(shopping=shopping, used=used_j.bit_count(), picked=picked + [j])
+                    continue
+                if shopping == best["shopping"] and (used_j | suffix_use[j + 1]).bit_count() <= best["used"]:
+                    continue
+                search(j + 1, left - 1, picked + [j], shop_j, used_j)
+
+        search(0, dishes, [], 0, 0)
+
+        shop = used = 0
+        for j in best["picked"]:
+            shop |= missing[j]
+            used |= use[j]
+        return {
+            "recipes": [self.recipe_ids[candidates[j][2]] for j in sorted(best["picked"])],
+            "shopping": self.ingredients(shop),
+            "used": self.ingredients(used),
+            "complete": state["complete"],
+            "nodes": state["nodes"],
+        }
+
+    @staticmethod
+    def _greedy(missing, use, dishes):
+        """Начальная оценка: каждый раз берем блюдо, меньше всего добавляющее к покупкам"""
+        picked, shop, used = [], 0, 0
+        for _ in range(dishes):
+            j = min(
+                (j for j in range(len(missing)) if j not in picked),
+                key=lambda j: ((shop | missing[j]).bit_count(), -(used | use[j]).bit_count(), j),
+            )
+            picked.append(j)
+            shop |= missing[j]
+            used |= use[j]
+        return {"shopping": shop.bit_count(), "used": used.bit_count(), "picked": picked}
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print('Использование: python meal_planner.py recipes.json "ингредиент, ингредиент" [блюд]')
+        sys.exit(1)
+    from recipe_snapshot import load_recipes_json
+    recipes = load_recipes_json(sys.argv[1])
+    pantry = [item.strip() for item in sys.argv[2].split(",") if item.strip()]
+    dishes = int(sys.argv[3]) if len(sys.argv) == 4 else 3
+    started = time.perf_counter()
+    plan = MealPlanner(recipes).plan(pantry, dishes)
+    elapsed = (time.perf_counter() - started) * 1000
+    if plan is None:
+        print("Из этого ничего не приготовить")
+        return
+    print(f"{'оптимум' if plan['complete'] else 'лучшее за бюджет'}: {plan['nodes']} узлов за {elapsed:.1f} мс")
+    print(f"  блюда: {', '.join(plan['recipes'])}")
+    print(f"  докупить: {', '.join(plan['shopping']) or '-'}")
+    print(f"  из холодильника: {', '.join(plan['used'])}")
+
+
+if __name__ == "__main__":
+    main()
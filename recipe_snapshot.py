@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Компактный бинарный снапшот базы рецептов.
+
+recipes.json компилируется один раз при сборке:
+
+    python recipe_snapshot.py recipes.json recipes.snap
+
+Бот открывает снапшот через mmap и декодирует рецепты лениво, по обращению,
+поэтому старт не зависит от размера базы, а несколько процессов делят одни
+и те же страницы памяти.
+
+Формат (little-endian, все массивы - uint32, выровнены по 4 байта):
+    заголовок   MAGIC, VERSION и таблица секций (смещение, число элементов)
+    str_offs    смещения строк в str_blob (count + 1)
+    str_blob    UTF-8 всех строк без повторов
+    ingredients индекс строки для каждого ингредиента (ID ингредиента = позиция)
+    recipes     по 8 чисел на рецепт, отсортированы по байтам id:
+                id, name, req_off, req_len, opt_off, opt_len, ins_off, ins_len
+    lists       общий пул списков: ID ингредиентов и индексы строк шагов
+    tokens      по 3 числа на запись префиксного индекса, отсортированы:
+                строка слова, приоритет, номер рецепта
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+
+MAGIC = b"RCPSNAP\0"
+VERSION = 1
+SECTIONS = ("str_offs", "str_blob", "ingredients", "recipes", "lists", "tokens")
+HEADER = struct.Struct("<8sI" + "II" * len(SECTIONS))
+RECIPE_FIELDS = 8
+TOKEN_FIELDS = 3
+
+
+def index_tokens(text):
+    return re.findall(r'\w+', text.lower().replace('_', ' '))
+
+
+def prefix_entries(recipes):
+    """Отсортированные (слово, приоритет, recipe_id) по названиям и ингредиентам"""
+    entries = set()
+    for recipe_id, recipe in recipes.items():
+        for token in index_tokens(recipe['name']):
+            entries.add((token, 0, recipe_id))  # совпадение в названии важнее
+        for ingredient in recipe['ingredients'] + recipe.get('optional', []):
+            for token in index_tokens(ingredient):
+                entries.add((token, 1, recipe_id))
+    return sorted(entries)
+
+
+def build_prefix_index(recipes):
+    """Префиксный индекс для bisect; у снапшота он уже лежит в файле"""
+    if isinstance(recipes, RecipeSnapshot):
+        return recipes.prefix_index()
+    entries = prefix_entries(recipes)
+    return {"tokens": [e[0] for e in entries], "entries": entries}
+
+
+# --- Build ---
+def compile_snapshot(recipes, path):
+    """Пишет снапшот атомарно: во временный файл и затем os.replace"""
+    strings, string_ids = [], {}
+
+    def intern(s):
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s)
+        return string_ids[s]
+
+    ingredients, ingredient_ids = [], {}
+
+    def ingredient(name):
+        if name not in ingredient_ids:
+            ingredient_ids[name] = len(ingredients)
+            ingredients.append(intern(name))
+        return ingredient_ids[name]
+
+    recipe_ids = sorted(recipes, key=lambda rid: rid.encode())
+    recipe_index = {rid: i for i, rid in enumerate(recipe_ids)}
+    records, pool = [], []
+    for rid in recipe_ids:
+        recipe = recipes[rid]
+        record = [intern(rid), intern(recipe['name'])]
+        for items, convert in (
+            (recipe['ingredients'], ingredient),
+            (recipe.get('optional', []), ingredient),
+            (recipe['instructions'], intern),
+        ):
+            record += [len(pool), len(items)]
+            pool += [convert(item) for item in items]
+        records += record
+
+    tokens = []
+    for token, priority, rid in prefix_entries(recipes):
+        tokens += [intern(token), priority, recipe_index[rid]]
+
+    blob, offs = bytearray(), [0]
+    for s in strings:
+        blob += s.encode()
+        offs.append(len(blob))
+
+    payloads = {
+        "str_offs": (uint32_bytes(offs), len(offs)),
+        "str_blob": (bytes(blob), len(blob)),
+        "ingredients": (uint32_bytes(ingredients), len(ingredients)),
+        "recipes": (uint32_bytes(records), len(recipe_ids)),
+        "lists": (uint32_bytes(pool), len(pool)),
+        "tokens": (uint32_bytes(tokens), len(tokens) // TOKEN_FIELDS),
+    }
+
+    table, body, offset = [], bytearray(), HEADER.size
+    for name in SECTIONS:
+        data, count = payloads[name]
+        padding = (-offset) % 4
+        body += b"\0" * padding
+        offset += padding
+        table += [offset, count]
+        body += data
+        offset += len(data)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, *table))
+        f.write(body)
+    os.replace(tmp_path, path)
+    return len(recipe_ids)
+
+
+def uint32_bytes(values):
+    return struct.pack(f"<{len(values)}I", *values)
+
+
+# --- Read ---
+class LazySequence(Sequence):
+    def __init__(self, length, getter):
+        self._length = length
+        self._getter = getter
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        return self._getter(i)
+
+
+class RecipeSnapshot(Mapping):
+    """Рецепты из mmap-снапшота с интерфейсом обычного dict recipe_id -> рецепт"""
+
+    def __init__(self, path, cache_size=4096):
+        if sys.byteorder != "little":
+            raise ValueError("snapshot format is little-endian only")
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mm)
+        magic, version, *table = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a recipe snapshot v{VERSION}")
+        sections = {name: (table[2 * i], table[2 * i + 1]) for i, name in enumerate(SECTIONS)}
+
+        def uint32s(name, width=1):
+            offset, count = sections[name]
+            return view[offset:offset + 4 * count * width].cast("I")
+
+        offset, size = sections["str_blob"]
+        self._blob = view[offset:offset + size]
+        self._str_offs = uint32s("str_offs")
+        self._ingredients = uint32s("ingredients")
+        self._records = uint32s("recipes", RECIPE_FIELDS)
+        self._lists = uint32s("lists")
+        self._tokens = uint32s("tokens", TOKEN_FIELDS)
+        self._count = sections["recipes"][1]
+        self._recipe = lru_cache(maxsize=cache_size)(self._decode_recipe)
+
+    def _bytes(self, i):
+        return self._blob[self._str_offs[i]:self._str_offs[i + 1]]
+
+    def _str(self, i):
+        return bytes(self._bytes(i)).decode()
+
+    def _field(self, index, field):
+        return self._records[index * RECIPE_FIELDS + field]
+
+    def _list(self, index, field):
+        start = self._field(index, field)
+        return self._lists[start:start + self._field(index, field + 1)]
+
+    def _find(self, recipe_id):
+        key = recipe_id.encode()
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self._bytes(self._field(mid, 0))) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and bytes(self._bytes(self._field(lo, 0))) == key:
+            return lo
+        return None
+
+    def _decode_recipe(self, index):
+        return {
+            "name": self._str(self._field(index, 1)),
+            "ingredients": [self.ingredient_name(i) for i in self._list(index, 2)],
+            "optional": [self.ingredient_name(i) for i in self._list(index, 4)],
+            "instructions": [self._str(i) for i in self._list(index, 6)],
+        }
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self._str(self._field(index, 0))
+
+    def __getitem__(self, recipe_id):
+        index = self._find(recipe_id) if isinstance(recipe_id, str) else None
+        if index is None:
+            raise KeyError(recipe_id)
+        return self._recipe(index)
+
+    def __contains__(self, recipe_id):
+        return isinstance(recipe_id, str) and self._find(recipe_id) is not None
+
+    def ingredient_name(self, ingredient_id):
+        return self._str(self._ingredients[ingredient_id])
+
+    def ingredient_names(self):
+        """Названия ингредиентов по их ID"""
+        return [self.ingredient_name(i) for i in range(len(self._ingredients))]
+
+    def ingredient_ids(self, recipe_id):
+        """Интернированные ID обязательных и дополнительных ингредиентов"""
+        index = self._find(recipe_id)
+        if index is None:
+            raise KeyError(recipe_id)
+        return list(self._list(index, 2)), list(self._list(index, 4))
+
+    def prefix_index(self):
+        def token(i):
+            return self._str(self._tokens[i * TOKEN_FIELDS])
+
+        def entry(i):
+            base = i * TOKEN_FIELDS
+            recipe_id = self._str(self._field(self._tokens[base + 2], 0))
+            return token(i), self._tokens[base + 1], recipe_id
+
+        count = len(self._tokens) // TOKEN_FIELDS
+        return {"tokens": LazySequence(count, token), "entries": LazySequence(count, entry)}
+
+
+def interned_ingredients(recipes):
+    """Ингредиенты всех рецептов как ID: (названия по ID, {recipe_id: (обязательные, дополнительные)}).
+    У снапшота ID уже лежат в файле, и рецепты целиком не декодируются"""
+    if isinstance(recipes, RecipeSnapshot):
+        return recipes.ingredient_names(), {rid: recipes.ingredient_ids(rid) for rid in recipes}
+    names, ids = [], {}
+
+    def intern(name):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        return ids[name]
+
+    return names, {
+        rid: ([intern(i) for i in recipe['ingredients']], [intern(i) for i in recipe.get('optional', [])])
+        for rid, recipe in recipes.items()
+    }
+
+
+def load_recipes_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("Использование: python recipe_snapshot.py recipes.json recipes.snap")
+        sys.exit(1)
+    source, target = sys.argv[1:]
+    count = compile_snapshot(load_recipes_json(source), target)
+    print(f"✅ {count} рецептов -> {target} ({os.path.getsize(target)} байт)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Векторный движок по разреженной матрице рецепт x ингредиент.
+
+Матрица строится один раз на базу рецептов и хранится в CSR: для каждого
+рецепта - отсортированные ID его ингредиентов. По ней:
+
+    match(pantry)   доля обязательных ингредиентов, которые есть в холодильнике,
+                    для всех рецептов сразу: одно умножение матрицы на вектор
+    similar(id)     top-K похожих блюд по Jaccard наборов ингредиентов,
+                    посчитанные пачкой для всех рецептов при построении
+
+С numpy пересечения считаются блоками строк: блок разворачивается в плотную
+матрицу и умножается на CSR всей базы (gather + reduceat), память на блок
+ограничена BLOCK_CELLS. Без numpy пересечения собираются через
+ингредиент -> рецепты, то есть сравниваются только рецепты с общими
+ингредиентами, а не все пары.
+
+    python recipe_vectors.py recipes.json   # соседи для каждого рецепта
+"""
+
+import sys
+from collections import Counter
+
+from recipe_snapshot import interned_ingredients
+
+try:
+    import numpy as np
+except ImportError:  # бот работает и без numpy, только медленнее на больших базах
+    np = None
+
+BLOCK_CELLS = 1 << 22  # ячеек во временной матрице блока, ~32 МБ float64
+
+
+class RecipeMatrix:
+    def __init__(self, recipes, top_k=5):
+        names, ingredient_ids = interned_ingredients(recipes)
+        self.recipe_ids = list(ingredient_ids)
+        self.vocab = {name: i for i, name in enumerate(names)}
+        required, everything = [], []
+        for rid in self.recipe_ids:
+            req, opt = map(set, ingredient_ids[rid])
+            required.append(sorted(req))
+            everything.append(sorted(req | opt))
+        self.required_counts = [len(ids) for ids in required]
+        self.sizes = [len(ids) for ids in everything]
+        if np is not None:
+            self._required = self._csr(required)
+            self._everything = self._csr(everything)
+        else:
+            self._required = required
+            self._everything = everything
+            self._postings = [[] for _ in self.vocab]
+            for row, ids in enumerate(everything):
+                for i in ids:
+                    self._postings[i].append(row)
+        self.neighbours = self._all_neighbours(top_k)
+
+    # --- numpy ---
+    def _csr(self, rows):
+        lengths = np.array([len(ids) for ids in rows], dtype=np.int64)
+        indices = np.fromiter((i for ids in rows for i in ids), dtype=np.int64, count=int(lengths.sum()))
+        row_of = np.repeat(np.arange(len(rows)), lengths)
+        return {"indptr": np.concatenate(([0], np.cumsum(lengths))), "indices": indices, "row_of": row_of}
+
+    def _pantry_vector(self, ingredients):
+        vector = np.zeros(len(self.vocab))
+        ids = [self.vocab[i] for i in ingredients if i in self.vocab]
+        vector[ids] = 1.0
+        return vector
+
+    # --- Queries ---
+    def match(self, ingredients, threshold):
+        """[(recipe_id, доля обязательных в наличии)] для рецептов не ниже threshold"""
+        if not self.recipe_ids:
+            return []
+        if np is not None:
+            csr = self._required
+            # CSR x вектор: сумма весов ингредиентов по строкам
+            have = np.bincount(csr["row_of"], weights=self._pantry_vector(ingredients)[csr["indices"]],
+                               minlength=len(self.recipe_ids))
+            scores = have / np.maximum(self.required_counts, 1)
+            rows = np.flatnonzero(scores >= threshold)
+            return [(self.recipe_ids[row], float(scores[row])) for row in rows]
+        pantry = {self.vocab[i] for i in ingredients if i in self.vocab}
+        have = [sum(1 for i in ids if i in pantry) for ids in self._required]
+        return [
+            (self.recipe_ids[row], have[row] / self.required_counts[row])
+            for row in range(len(self.recipe_ids))
+            if self.required_counts[row] and have[row] / self.required_counts[row] >= threshold
+        ]
+
+    def similar(self, recipe_id):
+        """[(recipe_id, Jaccard)] самых похожих рецептов, лучшие первыми"""
+        return self.neighbours.get(recipe_id, [])
+
+    def _all_neighbours(self, top_k):
+        if np is not None:
+            return self._all_neighbours_numpy(top_k)
+        neighbours = {}
+        for row, rid in enumerate(self.recipe_ids):
+            others, shared = self._shared_counts(row)
+            scored = [
+                (shared_count / (self.sizes[row] + self.sizes[other] - shared_count), other)
+                for other, shared_count in zip(others, shared)
+                if other != row
+            ]
+            scored.sort(key=lambda x: (-x[0], x[1]))
+            neighbours[rid] = [(self.recipe_ids[other], score) for score, other in scored[:top_k]]
+        return neighbours
+
+    def _shared_counts(self, row):
+        """Рецепты с общими ингредиентами и число общих, через ингредиент -> рецепты"""
+        counts = Counter(other for i in self._everything[row] for other in self._postings[i])
+        return list(counts), list(counts.values())
+
+    def _all_neighbours_numpy(self, top_k):
+        csr = self._everything
+        count, nnz = len(self.recipe_ids), len(csr["indices"])
+        sizes = np.array(self.sizes, dtype=np.float64)
+        starts = csr["indptr"][:-1]
+        nonempty = sizes > 0
+        block = max(1, BLOCK_CELLS // max(nnz, len(self.vocab), 1))
+        neighbours = {}
+        for lo in range(0, count, block):
+            hi = min(count, lo + block)
+            # Плотный блок строк lo..hi: рецепт x ингредиент
+            dense = np.zeros((hi - lo, len(self.vocab)))
+            a, b = csr["indptr"][lo], csr["indptr"][hi]
+            dense[csr["row_of"][a:b] - lo, csr["indices"][a:b]] = 1.0
+            # Пересечения блока со всеми рецептами: сумма по ингредиентам каждой строки CSR
+            shared = np.zeros((hi - lo, count))
+            if nnz:
+                shared[:, nonempty] = np.add.reduceat(dense[:, csr["indices"]], starts[nonempty], axis=1)
+            union = sizes[lo:hi, None] + sizes[None, :] - shared
+            scores = np.divide(shared, union, out=np.zeros_like(shared), where=union > 0)
+            scores[np.arange(hi - lo), np.arange(lo, hi)] = 0.0  # сам с собой не сосед
+            k = min(top_k, count - 1)
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k > 0 else np.zeros((hi - lo, 0), dtype=int)
+            for offset, row in enumerate(range(lo, hi)):
+                picked = sorted(((-scores[offset, other], other) for other in best[offset] if scores[offset, other] > 0))
+                neighbours[self.recipe_ids[row]] = [(self.recipe_ids[other], float(-score)) for score, other in picked]
+        return neighbours
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Использование: python recipe_vectors.py recipes.json")
+        sys.exit(1)
+    from recipe_snapshot import load_recipes_json
+    recipes = load_recipes_json(sys.argv[1])
+    matrix = RecipeMatrix(recipes)
+    print(f"{'numpy' if np is not None else 'без numpy'}: {len(recipes)} рецептов x {len(matrix.vocab)} ингредиентов")
+    for rid in matrix.recipe_ids:
+        similar = ", ".join(f"{other} ({score:.2f})" for other, score in matrix.similar(rid))
+        print(f"  {rid}: {similar or '-'}")
+
+
+if __name__ == "__main__":
+    main()
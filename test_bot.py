@@ -12,8 +12,32 @@ from main import (
     detect_gender_correction,
     parse_ingredients,
     find_matching_recipes,
-    get_gender_pronoun
+    get_gender_pronoun,
+    take_token,
+    RATE_LIMIT_BURST,
+    search_recipes,
+    bati_greeting,
+    bati_cooking_step,
+    RECIPES
 )
+from recipe_snapshot import RecipeSnapshot, compile_snapshot
+import tempfile
+import time
+from contextlib import contextmanager
+import main
+
+@contextmanager
+def temp_db():
+    """Временная БД основного тенанта; после теста прежний путь возвращается"""
+    old_path = main.DEFAULT_TENANT["db_path"]
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DEFAULT_TENANT["db_path"] = os.path.join(tmp, "bot.db")
+        try:
+            main.init_db()
+            yield main.DEFAULT_TENANT["db_path"]
+        finally:
+            main.wait_for_writes()
+            main.DEFAULT_TENANT["db_path"] = old_path
 
 def test_gender_detection():
     """Тестируем определение пола по имени"""
@@ -98,6 +122,662 @@ def test_pronouns():
         status = "✅" if result["you"] == expected["you"] and result["address"] == expected["address"] else "❌"
         print(f"  {status} {gender} -> {result['you']}, {result['address']}")
 
+def test_token_bucket():
+    """Тестируем ограничение флуда"""
+    print("\n🧪 Тестируем token bucket...")
+    
+    user_id = "flood-test"
+    allowed = sum(take_token(user_id, now=1000.0) for _ in range(int(RATE_LIMIT_BURST) + 3))
+    status = "✅" if allowed == int(RATE_LIMIT_BURST) else "❌"
+    print(f"  {status} пачка из {int(RATE_LIMIT_BURST) + 3} -> пропущено {allowed}")
+    assert allowed == int(RATE_LIMIT_BURST)
+    
+    refilled = take_token(user_id, now=1010.0)
+    status = "✅" if refilled else "❌"
+    print(f"  {status} через 10 секунд -> {refilled}")
+    assert refilled
+    
+    take_token("someone-else", now=1010.0 + main.BUCKET_SWEEP_INTERVAL)
+    evicted = user_id not in main.user_buckets
+    status = "✅" if evicted else "❌"
+    print(f"  {status} полная корзина выкинута при чистке")
+    assert evicted
+
+def test_admission_replies():
+    """Тестируем ответы на отсеянные апдейты: через воркер, а не из вебхука"""
+    print("\n🧪 Тестируем ответы на отсеянные апдейты...")
+    
+    replies = []
+    dispatch_update = main.dispatch_update
+    call_api = main.call_api
+    main.dispatch_update = lambda data, profile=False, reply=None: replies.append(reply)
+    main.call_api = lambda *args, **kwargs: (_ for _ in ()).throw(AssertionError("вызов Bot API из вебхука"))
+    try:
+        stale = {"message": {"date": int(time.time()) - main.MAX_UPDATE_AGE - 10, "chat": {"id": 555}, "from": {"id": 555}}}
+        assert not main.admit_update(stale)
+        user_id = "click-test"
+        for _ in range(int(RATE_LIMIT_BURST)):
+            take_token(user_id)
+        click = {"callback_query": {"id": "cb1", "from": {"id": user_id}, "data": "step:x:1:u", "message": {"chat": {"id": 556}}}}
+        assert not main.admit_update(click)
+    finally:
+        main.dispatch_update = dispatch_update
+        main.call_api = call_api
+    methods = [reply[0] for reply in replies]
+    ok = methods == ["sendMessage", "answerCallbackQuery"] and replies[1][1]["callback_query_id"] == "cb1"
+    status = "✅" if ok else "❌"
+    print(f"  {status} устаревший апдейт и флуд кнопкой -> {methods}")
+    assert ok
+
+def test_inbox_replay():
+    """Тестируем переигрывание inbox после рестарта: устаревшее не переигрывается"""
+    print("\n🧪 Тестируем переигрывание inbox...")
+    
+    now = int(time.time())
+    stale = {"update_id": 1, "message": {"date": now - main.MAX_UPDATE_AGE - 10, "chat": {"id": 557}, "from": {"id": 557}, "text": "привет"}}
+    fresh = {"update_id": 2, "message": {"date": now, "chat": {"id": 558}, "from": {"id": 558}, "text": "привет"}}
+    dispatched = []
+    dispatch_update = main.dispatch_update
+    main.dispatch_update = lambda data, profile=False, reply=None: dispatched.append((data.get("update_id"), reply and reply[0]))
+    try:
+        with temp_db():
+            main.store_update(stale)
+            main.store_update(fresh)
+            main.replay_inbox()
+            main.wait_for_writes()
+            conn = main.get_db()
+            statuses = dict(conn.execute("SELECT update_id, status FROM inbox").fetchall())
+            conn.close()
+    finally:
+        main.dispatch_update = dispatch_update
+    ok = dispatched == [(1, "sendMessage"), (2, None)] and statuses == {1: "done", 2: "pending"}
+    status = "✅" if ok else "❌"
+    print(f"  {status} устаревшее закрыто с одним ответом, свежее переиграно: {dispatched}, {statuses}")
+    assert ok
+
+def test_db_writer():
+    """Тестируем писателя БД: пачки, read-your-writes и ошибки"""
+    print("\n🧪 Тестируем писателя БД...")
+    
+    def write_counter(cur, key):
+        cur.execute("INSERT INTO stats_counters (key, value) VALUES (?, 1)", (key,))
+    
+    def write_broken(cur):
+        raise ValueError("сломанная запись")
+    
+    batches = []
+    commit_batch = main.commit_batch
+    main.commit_batch = lambda conn, cur, batch: (batches.append(len(batch)), commit_batch(conn, cur, batch))
+    try:
+        with temp_db():
+            futures = [main.db_write(write_counter, f"w:{i}") for i in range(50)]
+            broken = main.db_write(write_broken)
+            # Без явного ожидания: get_db сам дожидается записей этого потока
+            conn = main.get_db()
+            stored = conn.execute("SELECT COUNT(*) FROM stats_counters WHERE key LIKE 'w:%'").fetchone()[0]
+            conn.close()
+            ok = stored == 50 and all(f.done() and f.exception() is None for f in futures)
+            status = "✅" if ok else "❌"
+            print(f"  {status} 50 записей видны сразу, коммитов: {len(batches)}")
+            assert ok and len(batches) < 50
+            
+            failed = isinstance(broken.exception(timeout=2), ValueError)
+            status = "✅" if failed else "❌"
+            print(f"  {status} ошибка одной записи уходит в ее Future, остальные закоммичены")
+            assert failed
+    finally:
+        main.commit_batch = commit_batch
+    
+    with main.use_tenant(dict(main.DEFAULT_TENANT, db_path="/nonexistent/dir/bot.db")):
+        future = main.db_write(write_counter, "x")
+    error = future.exception(timeout=2)
+    alive = main.writer_thread.is_alive()
+    status = "✅" if error is not None and alive else "❌"
+    print(f"  {status} БД не открывается: {type(error).__name__}, писатель жив: {alive}")
+    assert error is not None and alive
+    assert main.db_write(lambda cur: None).result(timeout=2) is None
+
+def test_stage_counters_backfill():
+    """Тестируем счетчики этапов на базе, где сессии были до счетчиков"""
+    print("\n🧪 Тестируем счетчики этапов...")
+    
+    with temp_db() as db_path:
+        conn = main.sqlite3.connect(db_path)
+        conn.execute("DROP TABLE stats_counters")
+        conn.executemany(
+            "INSERT INTO cooking_sessions (user_id, stage, data_json, updated_at) VALUES (?, ?, '{}', '')",
+            [("1", "cooking"), ("2", "cooking"), ("3", "ask_name")]
+        )
+        conn.commit()
+        conn.close()
+        main.init_db()
+        stages = main.get_stats()["sessions_per_stage"]
+        ok = stages == {"cooking": 2, "ask_name": 1}
+        status = "✅" if ok else "❌"
+        print(f"  {status} сессии по этапам после миграции: {stages}")
+        assert ok
+        
+        main.init_db()
+        assert main.get_stats()["sessions_per_stage"] == stages
+
+def test_daily_active_retention():
+    """Тестируем удаление старых дней из daily_active"""
+    print("\n🧪 Тестируем хранение DAU...")
+    
+    with temp_db() as db_path:
+        conn = main.sqlite3.connect(db_path)
+        conn.executemany(
+            "INSERT INTO daily_active (day, user_id) VALUES (?, ?)",
+            [("2000-01-01", "1"), ("2000-01-02", "2")]
+        )
+        conn.commit()
+        conn.close()
+        main.db_write(main.record_activity, 7)
+        main.wait_for_writes()
+        conn = main.sqlite3.connect(db_path)
+        rows = conn.execute("SELECT user_id FROM daily_active").fetchall()
+        conn.close()
+        ok = rows == [("7",)]
+        status = "✅" if ok else "❌"
+        print(f"  {status} дни старше {main.DAU_RETENTION_DAYS} удалены, остался сегодняшний: {rows}")
+        assert ok
+
+def test_admin_token():
+    """Тестируем проверку админского токена"""
+    print("\n🧪 Тестируем админский токен...")
+    
+    token = main.ADMIN_TOKEN
+    main.ADMIN_TOKEN = "secret"
+    try:
+        cases = [
+            ({"headers": {"X-Admin-Token": "secret"}}, True),
+            ({"headers": {"X-Admin-Token": "wrong"}}, False),
+            ({"query_string": {"token": "secret"}}, False),
+            ({}, False),
+        ]
+        for kwargs, expected in cases:
+            with main.app.test_request_context("/stats", **kwargs):
+                got = main.is_admin_request()
+            status = "✅" if got == expected else "❌"
+            print(f"  {status} {kwargs or 'без токена'} -> {got}")
+            assert got == expected
+    finally:
+        main.ADMIN_TOKEN = token
+
+def test_inline_search():
+    """Тестируем inline-поиск по префиксам"""
+    print("\n🧪 Тестируем inline-поиск...")
+    
+    test_cases = [
+        ("карб", ["паста_карбонара"]),
+        ("сыр мак", ["паста_карбонара"]),
+        ("свек", ["борщ"]),
+        ("ананас", []),
+    ]
+    
+    for query, expected in test_cases:
+        result = list(search_recipes(query))
+        status = "✅" if result == expected else "❌"
+        print(f"  {status} '{query}' -> {result}")
+        assert result == expected
+
+def test_persona_templates():
+    """Тестируем шаблоны бати"""
+    print("\n🧪 Тестируем шаблоны бати...")
+    
+    first = bati_greeting("Анна", "female")
+    second = bati_greeting("Анна", "female")
+    status = "✅" if first == second and "Анна" in first and "дочка" in first else "❌"
+    print(f"  {status} приветствие стабильно для пользователя: {first[:40]}...")
+    assert first == second and "Анна" in first and "дочка" in first
+    
+    step = bati_cooking_step(2, "Нарежь лук", "Иван", "male")
+    status = "✅" if "2" in step and "сынок" in step and step.endswith("Нарежь лук") else "❌"
+    print(f"  {status} шаг -> {step}")
+    assert "2" in step and "сынок" in step and step.endswith("Нарежь лук")
+
+def test_recipe_snapshot():
+    """Тестируем бинарный снапшот рецептов"""
+    print("\n🧪 Тестируем снапшот рецептов...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "recipes.snap")
+        compile_snapshot(dict(RECIPES), path)
+        snapshot = RecipeSnapshot(path)
+        
+        same = len(snapshot) == len(RECIPES) and all(snapshot[rid] == RECIPES[rid] for rid in RECIPES)
+        status = "✅" if same else "❌"
+        print(f"  {status} {len(snapshot)} рецептов совпадают с исходными")
+        assert same
+        
+        status = "✅" if "борщ" in snapshot and "пицца" not in snapshot else "❌"
+        print(f"  {status} поиск по id")
+        assert "борщ" in snapshot and "пицца" not in snapshot
+        
+        # Матрица и планировщик берут ID ингредиентов прямо из снапшота
+        pantry = ["макароны", "яйца", "бекон", "мука", "молоко", "рис", "лук"]
+        from_json = main.RecipeMatrix(dict(RECIPES)), main.MealPlanner(dict(RECIPES))
+        from_snapshot = main.RecipeMatrix(snapshot), main.MealPlanner(snapshot)
+        same = (
+            sorted(from_json[0].match(pantry, 0.5)) == sorted(from_snapshot[0].match(pantry, 0.5))
+            and all(sorted(from_json[0].similar(rid)) == sorted(from_snapshot[0].similar(rid)) for rid in RECIPES)
+            and sorted(from_json[1].plan(pantry, 2)["recipes"]) == sorted(from_snapshot[1].plan(pantry, 2)["recipes"])
+        )
+        status = "✅" if same else "❌"
+        print(f"  {status} матрица и план по ID снапшота совпадают с JSON")
+        assert same
+        
+        porridge = {"каша": {"name": "Каша", "ingredients": ["крупа", "молоко"], "instructions": ["Свари кашу"]}}
+        compile_snapshot(porridge, path)
+        same = main.recipe_digest(RecipeSnapshot(path)["каша"]) == main.recipe_digest(porridge["каша"])
+        status = "✅" if same else "❌"
+        print(f"  {status} рецепт без optional: хэш для FTS из снапшота и из JSON одинаковый")
+        assert same
+
+def test_pantry_matches():
+    """Тестируем инкрементальный подбор по холодильнику"""
+    print("\n🧪 Тестируем холодильник...")
+    
+    def ranked(matches):
+        return sorted((m['id'], m['score'], sorted(m['missing_required'])) for m in matches)
+    
+    with temp_db():
+        user_id = 42
+        
+        main.update_pantry(user_id, add=["макароны", "яйца", "бекон", "сыр_пармезан", "рис", "лук"])
+        main.update_pantry(user_id, remove=["лук"])
+        items = main.pantry_items(user_id)
+        engine = main.MATCH_ENGINE
+        try:
+            for main.MATCH_ENGINE in ("sets", "matrix"):
+                same = ranked(main.pantry_matches(user_id)) == ranked(find_matching_recipes(items))
+                status = "✅" if same else "❌"
+                print(f"  {status} после 'добавь' и 'убери' совпадает с полным пересчетом ({main.MATCH_ENGINE})")
+                assert same
+        finally:
+            main.MATCH_ENGINE = engine
+        
+        main.pantries.clear()
+        restored = main.pantry_items(user_id) == items
+        status = "✅" if restored else "❌"
+        print(f"  {status} холодильник восстановлен из БД: {items}")
+        assert restored
+        assert ranked(main.pantry_matches(user_id)) == ranked(find_matching_recipes(items))
+
+def test_broadcast_resume():
+    """Тестируем рассылку: повтор временных ошибок, 403 и продолжение с чекпоинта"""
+    print("\n🧪 Тестируем рассылку...")
+    
+    class FakeResponse:
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.ok = status_code == 200
+        
+        def json(self):
+            return {}
+    
+    class Crash(BaseException):
+        """Падение процесса посреди рассылки"""
+    
+    sent, flaky = [], {"105"}
+    def fake_send(chat_id, text, reply_markup=None, durable=True):
+        if chat_id == "140" and crash["armed"]:
+            crash["armed"] = False
+            raise Crash()
+        if chat_id in flaky:
+            flaky.discard(chat_id)
+            return None  # сеть моргнула
+        if chat_id == "110":
+            return FakeResponse(403)
+        sent.append(chat_id)
+        return FakeResponse(200)
+    
+    crash = {"armed": True}
+    saved = main.send_message, main.BROADCAST_RATE, main.BROADCAST_RETRY_BASE
+    main.send_message, main.BROADCAST_RATE, main.BROADCAST_RETRY_BASE = fake_send, 1e6, 0
+    try:
+        with temp_db():
+            for user_id in range(100, 160):
+                main.upsert_user(user_id, f"user{user_id}")
+            broadcast_id = main.db_write(main.write_new_broadcast, "привет").result()
+            try:
+                main.run_broadcast(broadcast_id)
+            except Crash:
+                pass
+            main.wait_for_writes()
+            checkpoint = main.get_broadcast(broadcast_id)
+            ok = checkpoint["status"] == "running" and checkpoint["last_user_id"] == "139"
+            status = "✅" if ok else "❌"
+            print(f"  {status} после падения чекпоинт на {checkpoint['last_user_id']}")
+            assert ok
+            
+            main.run_broadcast(broadcast_id)
+            job = main.get_broadcast(broadcast_id)
+            blocked = main.get_db().execute("SELECT blocked FROM users WHERE user_id = '110'").fetchone()[0]
+            # Чекпоинт после каждого пользователя - после падения никому не ушло дважды
+            ok = (job["status"] == "done" and job["sent"] == 59 and job["blocked"] == 1 and job["failed"] == 0
+                  and blocked == 1 and "105" in sent and len(sent) == len(set(sent)) == 59)
+            status = "✅" if ok else "❌"
+            print(f"  {status} итог: отправлено {job['sent']}, заблокировали {job['blocked']}, ошибок {job['failed']}")
+            assert ok
+    finally:
+        main.send_message, main.BROADCAST_RATE, main.BROADCAST_RETRY_BASE = saved
+    
+    started, replies = [], []
+    saved = main.create_broadcast, main.send_message, main.DEFAULT_TENANT["admin_chat_id"]
+    main.create_broadcast = lambda text, report_chat_id=None: started.append(text) or 1
+    main.send_message = lambda chat_id, text, **kwargs: replies.append(text)
+    main.DEFAULT_TENANT["admin_chat_id"] = "77"
+    try:
+        with temp_db():
+            for message_id, length in ((901, 3000), (902, 5000)):
+                text = "/broadcast " + "а" * length
+                main.handle_update({"message": {"message_id": message_id, "date": 1, "chat": {"id": 77}, "from": {"id": 77}, "text": text}})
+    finally:
+        main.create_broadcast, main.send_message, main.DEFAULT_TENANT["admin_chat_id"] = saved
+    ok = [len(t) for t in started] == [3000, 4096] and "обрезан" not in replies[0] and "обрезан" in replies[1]
+    status = "✅" if ok else "❌"
+    print(f"  {status} текст рассылки не режется до {main.MAX_TEXT_LENGTH}, длиннее 4096 - режется с предупреждением")
+    assert ok
+
+def test_step_navigation():
+    """Тестируем кнопки шагов и завершение готовки текстом"""
+    print("\n🧪 Тестируем шаги...")
+    
+    recipe_id = "оладьи"
+    steps = len(RECIPES[recipe_id]['instructions'])
+    wrong = []
+    for step in (0, 1, steps - 1):
+        for gender in ("male", "female", "unknown"):
+            buttons = [b["callback_data"] for row in main.step_keyboard(recipe_id, step, gender)["inline_keyboard"] for b in row]
+            for data in buttons:
+                expected = (recipe_id, None if data.startswith("done:") else int(data.split(":")[2]), gender)
+                if len(data.encode()) > 64 or main.parse_step_callback(data) != expected:
+                    wrong.append(data)
+    status = "✅" if not wrong else "❌"
+    print(f"  {status} callback_data шагов разбирается обратно в рецепт, шаг и пол {wrong or ''}")
+    assert not wrong
+    assert main.parse_step_callback("step:nope:1:m") is None and main.parse_step_callback("step:x") is None
+    
+    sent = []
+    send_message = main.send_message
+    main.send_message = lambda chat_id, text, **kwargs: sent.append(text)
+    try:
+        with temp_db():
+            user_id = 77
+            main.save_session(user_id, "cooking", {"recipe_id": recipe_id, "name": "Иван", "gender": "male", "step": steps - 2})
+            main.schedule_timer(user_id, user_id, recipe_id, steps - 2, "Иван", "male", 600)
+            step_duration = main.step_duration
+            main.step_duration = lambda text: 600  # пусть и в последнем шаге будет время
+            try:
+                main.handle_cooking_step(user_id, user_id, "Иван", "male")
+            finally:
+                main.step_duration = step_duration
+            main.wait_for_writes()
+            stage = main.get_session(user_id)["stage"]
+            funnel = main.get_stats()["funnel"]["done"]
+            conn = main.get_db()
+            timer_rows = conn.execute("SELECT COUNT(*) FROM timers").fetchone()[0]
+            conn.close()
+            ok = stage == "done" and funnel == 1 and ("default", str(user_id)) not in main.timers and timer_rows == 0
+            status = "✅" if ok else "❌"
+            print(f"  {status} последний шаг текстом -> этап {stage}, в воронке done: {funnel}, таймеров: {timer_rows}")
+            assert ok
+            
+            # Кнопки сообщения прошлой готовки после /start
+            answers, edits = [], []
+            saved = main.answer_callback_query, main.edit_message
+            main.answer_callback_query = lambda callback_id, text=None: answers.append((callback_id, text))
+            main.edit_message = lambda chat_id, message_id, text, reply_markup=None: edits.append(text)
+            try:
+                user_id = 78
+                def press(callback_id, data):
+                    main.handle_update({"callback_query": {"id": callback_id, "data": data, "from": {"id": user_id},
+                                                           "message": {"message_id": 5, "chat": {"id": user_id}}}})
+                def button(step, label):
+                    return next(b["callback_data"] for row in main.step_keyboard(recipe_id, step, "male")["inline_keyboard"]
+                                for b in row if label in b["text"])
+                
+                main.handle_recipe_selection(user_id, user_id, recipe_id, "Иван", "male")
+                press("fresh", button(0, "Далее"))
+                fresh = answers == [("fresh", None)] and len(edits) == 1 and main.recall_cook(user_id)["step"] == 1
+                status = "✅" if fresh else "❌"
+                print(f"  {status} 'Далее' текущего рецепта листает шаг")
+                assert fresh
+                
+                main.handle_update({"message": {"message_id": 903, "date": 1, "chat": {"id": user_id}, "from": {"id": user_id}, "text": "/start"}})
+                answers.clear(), edits.clear()
+                press("old-next", button(1, "Далее"))
+                press("old-done", button(steps - 1, "Готово"))
+                main.wait_for_writes()
+                ok = (main.get_session(user_id)["stage"] == "ask_name" and main.recall_cook(user_id) is None
+                      and ("default", str(user_id)) not in main.timers and not edits
+                      and [a[0] for a in answers] == ["old-next", "old-done"] and all("не активен" in a[1] for a in answers))
+                status = "✅" if ok else "❌"
+                print(f"  {status} старые 'Далее' и 'Готово' после /start сессию не трогают: {answers}")
+                assert ok
+            finally:
+                main.answer_callback_query, main.edit_message = saved
+    finally:
+        main.send_message = send_message
+
+def test_circuit_breaker():
+    """Тестируем предохранитель Bot API"""
+    print("\n🧪 Тестируем предохранитель...")
+    
+    for _ in range(main.BREAKER_FAILURES):
+        main.breaker_record(False)
+    opened = main.breaker_open() and not main.breaker_allow()
+    status = "✅" if opened else "❌"
+    print(f"  {status} после {main.BREAKER_FAILURES} ошибок подряд разомкнут")
+    assert opened
+    
+    main.breaker["opened_at"] -= main.BREAKER_COOLDOWN
+    probe = main.breaker_allow() and not main.breaker_allow()
+    status = "✅" if probe else "❌"
+    print(f"  {status} после остывания пропускает один пробный вызов")
+    assert probe
+    
+    main.breaker_record(True)
+    closed = main.breaker_status()["state"] == "closed" and main.breaker_allow()
+    status = "✅" if closed else "❌"
+    print(f"  {status} удачная проба замыкает предохранитель")
+    assert closed
+
+def test_fair_queue():
+    """Тестируем очередь воркера с обходом тенантов по кругу"""
+    print("\n🧪 Тестируем справедливую очередь...")
+    
+    q = main.FairQueue()
+    for i in range(3):
+        q.put("noisy", f"noisy{i}")
+    q.put("quiet", "quiet0")
+    order = [q.get() for _ in range(4)]
+    fair = order == ["noisy0", "quiet0", "noisy1", "noisy2"]
+    status = "✅" if fair else "❌"
+    print(f"  {status} {order}")
+    assert fair
+
+def test_recipe_matrix():
+    """Тестируем матричный подбор и похожие блюда"""
+    print("\n🧪 Тестируем матрицу рецептов...")
+    
+    def ranked(matches):
+        return sorted((m['id'], m['score'], sorted(m['missing_required'])) for m in matches)
+    
+    pantry = ["макароны", "яйца", "бекон", "сыр_пармезан", "чеснок", "рис", "мясо", "морковь", "лук", "соль"]
+    engine = main.MATCH_ENGINE
+    try:
+        main.MATCH_ENGINE = "matrix"
+        by_matrix = ranked(find_matching_recipes(pantry))
+        main.MATCH_ENGINE = "sets"
+        by_sets = ranked(find_matching_recipes(pantry))
+    finally:
+        main.MATCH_ENGINE = engine
+    status = "✅" if by_matrix == by_sets and by_matrix else "❌"
+    print(f"  {status} матрица и перебор множеств нашли одно и то же: {[m[0] for m in by_matrix]}")
+    assert by_matrix == by_sets and by_matrix
+    
+    similar = main.recipe_matrix(main.current_tenant()["corpus"]).similar("паста_карбонара")
+    scores = [score for _, score in similar]
+    ok = similar and "паста_карбонара" not in [rid for rid, _ in similar] and scores == sorted(scores, reverse=True)
+    status = "✅" if ok else "❌"
+    print(f"  {status} похожие на карбонару: {similar}")
+    assert ok
+
+def test_full_text_search():
+    """Тестируем полнотекстовый поиск по рецептам и шагам"""
+    print("\n🧪 Тестируем полнотекстовый поиск...")
+    
+    with temp_db():
+        indexed = main.sync_search_index()
+        status = "✅" if indexed == len(main.RECIPES) else "❌"
+        print(f"  {status} проиндексировано рецептов: {indexed}")
+        assert indexed == len(main.RECIPES)
+        
+        results = main.search_corpus_text("как жарить оладьи")
+        found = bool(results) and results[0]["id"] == "оладьи" and results[0]["step"] >= 0
+        status = "✅" if found else "❌"
+        print(f"  {status} 'как жарить оладьи' -> {results[:1]}")
+        assert found
+        
+        again = main.sync_search_index()
+        status = "✅" if again == 0 else "❌"
+        print(f"  {status} повторная синхронизация ничего не трогает: {again}")
+        assert again == 0
+        assert main.search_corpus_text("спасибо") == []
+
+def test_meal_planner():
+    """Тестируем план обеда из нескольких блюд"""
+    print("\n🧪 Тестируем план обеда...")
+    
+    from itertools import combinations
+    pantry = ["макароны", "яйца", "бекон", "сыр_пармезан", "мука", "молоко", "сахар", "соль", "рис", "курица"]
+    planner = main.MealPlanner(main.RECIPES)
+    plan = planner.plan(pantry, dishes=2)
+    
+    # Полный перебор пар для сравнения
+    have = set(pantry)
+    def cost(pair):
+        required = set().union(*(RECIPES[r]['ingredients'] for r in pair))
+        everything = required.union(*(RECIPES[r].get('optional', []) for r in pair))
+        return len(required - have), -len(everything & have)
+    best = min(cost(pair) for pair in combinations(RECIPES, 2))
+    got = cost(plan['recipes'])
+    status = "✅" if got == best and plan['complete'] else "❌"
+    print(f"  {status} {plan['recipes']}, докупить {plan['shopping']}")
+    assert got == best and plan['complete']
+    assert len(plan['shopping']) == best[0]
+    
+    nothing = planner.plan(["гвозди"], dishes=2)
+    status = "✅" if nothing is None else "❌"
+    print(f"  {status} из пустого холодильника плана нет")
+    assert nothing is None
+
+def test_cooking_timers():
+    """Тестируем таймеры шагов"""
+    print("\n🧪 Тестируем таймеры...")
+    
+    cases = {
+        "Накрой полотенцем, дай подойти 30 минут": 1800,
+        "Томи 1 час 30 минут": 5400,
+        "Залей горячей водой на 2 см выше риса": None,
+    }
+    for text, expected in cases.items():
+        got = main.step_duration(text)
+        status = "✅" if got == expected else "❌"
+        print(f"  {status} '{text}' -> {got}")
+        assert got == expected
+    
+    def stored_timers():
+        conn = main.get_db()
+        rows = conn.execute("SELECT chat_id FROM timers").fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+    
+    sent = []
+    send_message = main.send_message
+    main.send_message = lambda chat_id, text, **kwargs: sent.append((chat_id, text, kwargs))
+    try:
+        with temp_db():
+            main.schedule_timer(1, 1, "борщ", 6, "Иван", "male", 600)
+            main.wait_for_writes()
+            main.timers.clear()  # как после рестарта
+            main.resume_timers()
+            resumed = ("default", "1") in main.timers and stored_timers() == ["1"]
+            status = "✅" if resumed else "❌"
+            print(f"  {status} таймер поднят из БД после рестарта")
+            assert resumed
+            main.cancel_timer(1)
+            
+            main.schedule_timer(2, 2, "оладьи", 5, "Анна", "female", 1800, due_at=time.time() + 0.05)
+            deadline = time.time() + 3
+            while not sent and time.time() < deadline:
+                time.sleep(0.01)
+            main.timer_due.join()
+            fired = sent and sent[0][0] == 2 and "Дальше" in sent[0][1] and sent[0][2].get("reply_markup")
+            status = "✅" if fired else "❌"
+            print(f"  {status} напоминание со следующим шагом: {sent[0][1][:60] if sent else None}")
+            assert fired
+            while "2" in stored_timers() and time.time() < deadline:
+                time.sleep(0.01)
+            assert stored_timers() == []
+            
+            key = ("default", "3")
+            main.schedule_timer(3, 3, "борщ", 6, "Иван", "male", 600)
+            main.handle_recipe_selection(3, 3, "паста_карбонара", "Иван", "male")
+            main.wait_for_writes()
+            replaced = main.timers.get(key, {}).get("recipe_id") in (None, "паста_карбонара")
+            status = "✅" if replaced else "❌"
+            print(f"  {status} новый рецепт снимает таймер старого")
+            assert replaced
+            
+            main.schedule_timer(3, 3, "борщ", 6, "Иван", "male", 600)
+            main.handle_update({"message": {"message_id": 1, "date": 1, "chat": {"id": 3}, "from": {"id": 3}, "text": "/start"}})
+            main.wait_for_writes()
+            reset = key not in main.timers and "3" not in stored_timers()
+            status = "✅" if reset else "❌"
+            print(f"  {status} /start снимает таймер")
+            assert reset
+    finally:
+        main.send_message = send_message
+
+def test_export_stream():
+    """Тестируем потоковую выгрузку таблиц"""
+    print("\n🧪 Тестируем выгрузку...")
+    
+    import csv, gzip, io, json
+    from export_db import export_stream
+    with temp_db() as db_path:
+        for user_id in range(1, 2501):
+            main.upsert_user(user_id, f"user{user_id}")
+        main.wait_for_writes()
+        
+        stats = {}
+        rows = [json.loads(line) for line in b"".join(export_stream(db_path, "users", stats=stats)).decode().splitlines()]
+        ok = len(rows) == stats["rows"] == 2500 and stats["watermark"] == rows[-1]["updated_at"]
+        status = "✅" if ok else "❌"
+        print(f"  {status} NDJSON: {stats['rows']} строк, водяной знак {stats['watermark']}")
+        assert ok
+        
+        since = rows[1999]["updated_at"]
+        newer = [r for r in rows if r["updated_at"] > since]
+        data = gzip.decompress(b"".join(export_stream(db_path, "users", "csv", since, compress=True))).decode()
+        table = list(csv.reader(io.StringIO(data)))
+        ok = table[0][0] == "user_id" and len(table) - 1 == len(newer)
+        status = "✅" if ok else "❌"
+        print(f"  {status} CSV+gzip с водяным знаком: {len(table) - 1} новых строк")
+        assert ok
+        
+        try:
+            list(export_stream(db_path, "daily_active", since="2026-10-01"))
+            refused = False
+        except ValueError:
+            refused = True
+        status = "✅" if refused else "❌"
+        print(f"  {status} daily_active выгружается только целиком")
+        assert refused
+
 if __name__ == "__main__":
     print("🚀 Запуск тестов кулинарного бота...")
     print("=" * 50)
@@ -107,6 +787,26 @@ if __name__ == "__main__":
     test_ingredient_parsing()
     test_recipe_matching()
     test_pronouns()
+    test_token_bucket()
+    test_admission_replies()
+    test_inbox_replay()
+    test_db_writer()
+    test_stage_counters_backfill()
+    test_daily_active_retention()
+    test_admin_token()
+    test_inline_search()
+    test_persona_templates()
+    test_recipe_snapshot()
+    test_pantry_matches()
+    test_broadcast_resume()
+    test_step_navigation()
+    test_circuit_breaker()
+    test_fair_queue()
+    test_recipe_matrix()
+    test_full_text_search()
+    test_meal_planner()
+    test_cooking_timers()
+    test_export_stream()
     
     print("\n" + "=" * 50)
     print("✅ Тесты завершены!")